@@ -1,14 +1,17 @@
 import zipfile
 import os
+import stat
+import posixpath
+import collections
 import re
-import uuid
-from StringIO import StringIO
-import datetime
-
-try:
-    import lxml.etree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
+import struct
+import mmap
+import zlib
+from cStringIO import StringIO
+import time
+from timeit import default_timer
+# Slower imports (the XML parser, uuid, datetime, mimetypes, tempfile, urllib, multiprocessing) are deferred
+# to the code paths that need them, so that importing pyepub and reading metadata stay cheap
 
 NAMESPACE = {
     "dc": "{http://purl.org/dc/elements/1.1/}",
@@ -16,141 +19,1085 @@ NAMESPACE = {
     "ncx": "{http://www.daisy.org/z3986/2005/ncx/}"
 }
 
-ET.register_namespace('dc', "http://purl.org/dc/elements/1.1/")
-ET.register_namespace('opf', "http://www.idpf.org/2007/opf")
-ET.register_namespace('ncx', "http://www.daisy.org/z3986/2005/ncx/")
+
+class _LazyModule(object):
+    """
+    Stand-in for a module, imported by loader on first attribute access
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            self._module = self._loader()
+        return getattr(self._module, name)
+
+
+def _etree():
+    try:
+        import lxml.etree as etree
+    except ImportError:
+        import xml.etree.ElementTree as etree
+    etree.register_namespace('dc', "http://purl.org/dc/elements/1.1/")
+    etree.register_namespace('opf', "http://www.idpf.org/2007/opf")
+    etree.register_namespace('ncx', "http://www.daisy.org/z3986/2005/ncx/")
+    return etree
+
+ET = _LazyModule(_etree)    # lxml.etree if available, else xml.etree.ElementTree
+
+COPY_CHUNK_SIZE = 64 * 1024  # bytes moved per read() when copying raw archive members
+SPOOL_SIZE = 4 * 1024 * 1024  # pending writes are kept in memory up to this size, then spilled to disk
+
+
+NAMESPACE_RE = re.compile(r'\{.*?\}')  # RE to strip {namespace} mess
+# full-path of the first <rootfile> in container.xml, read without an XML parser
+ROOTFILE_RE = re.compile(r'<(?:[\w.-]+:)?rootfile\s[^>]*?\bfull-path\s*=\s*(["\'])([^"\'&<]+)\1')
+
+# (X)HTML elements whose text is yielded as a chunk by EPUB.itertext(), and elements whose text is skipped
+TEXT_BLOCKS = frozenset(["p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "li", "dt", "dd", "td", "th",
+                         "blockquote", "pre", "caption", "figcaption", "body"])
+TEXT_SKIPPED = frozenset(["head", "script", "style"])
 
 
 class InvalidEpub(Exception):
     pass
 
 
+class _lazy(object):
+    """
+    Attribute built by the decorated method on first access, then stored on the instance.
+    Plain assignment on the instance overrides it, just like any other attribute.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.__name__ = method.__name__
+        self.__doc__ = method.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.method(instance)
+        instance.__dict__[self.__name__] = value
+        return value
+
+
+def _iterparse(stream, events):
+    """
+    ET.iterparse(), knowing the HTML named entities (&nbsp;, &eacute;...) that XHTML documents use
+    without declaring them
+    """
+    if ET.__name__ == "lxml.etree":
+        return ET.iterparse(stream, events=events, recover=True)
+    import htmlentitydefs
+    parser = ET.XMLParser()
+    parser.entity.update((x, unichr(y)) for x, y in htmlentitydefs.name2codepoint.iteritems())
+    return ET.iterparse(stream, events, parser)
+
+
+def _itertext(stream):
+    """
+    Incrementally parse an (X)HTML document, yielding the text of its block elements in document order.
+    Elements are dropped as soon as they are consumed, so that memory doesn't grow with the document.
+
+    :type stream: file like object
+    :param stream: (X)HTML document
+    """
+    ancestors = []
+    for event, element in _iterparse(stream, ("start", "end")):
+        if event == "start":
+            ancestors.append(element)
+            continue
+        ancestors.pop()
+        tag = NAMESPACE_RE.sub('', element.tag)
+        if tag in TEXT_BLOCKS:
+            text = " ".join("".join(element.itertext()).split())
+            if text:
+                yield text
+        elif tag not in TEXT_SKIPPED:
+            continue    # inline element: its text is part of the enclosing block
+        if not ancestors:
+            continue
+        # Detach the element; its tail belongs to the parent, and goes to the previous sibling or the parent text
+        parent = ancestors[-1]
+        for index in xrange(len(parent) - 1, -1, -1):   # the parser may have read ahead: look from the end
+            if parent[index] is element:
+                del parent[index]
+                break
+        if element.tail:
+            if index:
+                parent[index - 1].tail = (parent[index - 1].tail or "") + element.tail
+            else:
+                parent.text = (parent.text or "") + element.tail
+
+
+class CompressionPolicy(object):
+    """
+    Which members of an EPUB are deflated, and how.
+    mimetype is always stored, as the OCF specification requires; so are media types
+    that are already compressed (images, audio, video, WOFF fonts). Everything else is
+    deflated at the given level, in a pool of threads if asked to.
+    """
+    STORED_TYPES = frozenset(["application/font-woff", "application/x-font-woff", "font/woff", "font/woff2",
+                              "application/zip", "application/epub+zip"])
+    STORED_FAMILIES = frozenset(["image", "audio", "video"])
+
+    def __init__(self, level=6, threads=None, stored_types=STORED_TYPES):
+        """
+        :type level: int
+        :param level: zlib compression level, 0 to store everything
+        :type threads: int
+        :param threads: members deflated concurrently when saving, None to deflate in the calling thread
+        :type stored_types: set
+        :param stored_types: media types never deflated, on top of image/*, audio/* and video/*
+        """
+        self.level = level
+        self.threads = threads
+        self.stored_types = stored_types
+
+    def compress_type(self, path, mediatype=None):
+        """
+        :type path: str
+        :param path: path of the member inside the archive
+        :type mediatype: str
+        :param mediatype: manifest media-type of the member, guessed from path if None
+        :return: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        """
+        if self.level == 0 or path == "mimetype":
+            return zipfile.ZIP_STORED
+        if mediatype is None:
+            import mimetypes
+            mediatype = mimetypes.guess_type(path)[0] or ""
+        if mediatype in self.stored_types:
+            return zipfile.ZIP_STORED
+        if mediatype.split("/")[0] in self.STORED_FAMILIES and not mediatype.endswith("+xml"):   # svg is text
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def compress(self, data):
+        """
+        Raw deflate stream of data, as stored in zip archives. zlib releases the GIL while compressing.
+        """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+
+
+class Stats(object):
+    """
+    Observer aggregating wall time, bytes read/written and member counts by phase:
+
+        >>> stats = Stats()
+        >>> epub = EPUB("file.epub", observer=stats)
+        >>> stats.phases["opf"]
+        {'calls': 1, 'seconds': 0.0009, 'bytes_read': 5823, 'bytes_written': 0, 'members': 1}
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    def __call__(self, phase, seconds, bytes_read, bytes_written, members):
+        totals = self.phases.get(phase)
+        if totals is None:
+            totals = self.phases[phase] = {"calls": 0, "seconds": 0.0, "bytes_read": 0, "bytes_written": 0,
+                                           "members": 0}
+        totals["calls"] += 1
+        totals["seconds"] += seconds
+        totals["bytes_read"] += bytes_read
+        totals["bytes_written"] += bytes_written
+        totals["members"] += members
+
+
+class _Phase(object):
+    """
+    Timed phase of an EPUB operation, reported to the observer on exit
+    """
+    __slots__ = ("observer", "name", "start", "bytes_read", "bytes_written", "members")
+
+    def __init__(self, observer, name):
+        self.observer = observer
+        self.name = name
+        self.bytes_read = self.bytes_written = self.members = 0
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.observer(self.name, default_timer() - self.start, self.bytes_read, self.bytes_written, self.members)
+
+    def add(self, read=0, written=0, members=0):
+        self.bytes_read += read
+        self.bytes_written += written
+        self.members += members
+
+
+class _NullPhase(object):
+    """
+    Stand-in for _Phase when there is no observer: does nothing, as cheaply as possible
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def add(self, read=0, written=0, members=0):
+        pass
+
+_NULL_PHASE = _NullPhase()
+
+
+class ManifestItem(object):
+    """
+    Item of the OPF <manifest>
+    """
+    __slots__ = ("id", "href", "mimetype", "element")
+
+    def __init__(self, element):
+        self.id = element.get("id")
+        self.href = element.get("href")
+        self.mimetype = element.get("media-type")
+        self.element = element
+
+    def as_dict(self):
+        return {"id": self.id, "href": self.href, "mimetype": self.mimetype}
+
+
+class SpineItem(object):
+    """
+    Item reference of the OPF <spine>
+    """
+    __slots__ = ("idref", "linear", "element")
+
+    def __init__(self, element):
+        self.idref = element.get("idref")
+        self.linear = element.get("linear", "yes")
+        self.element = element
+
+    def as_dict(self):
+        return {"idref": self.idref}
+
+
+class GuideItem(object):
+    """
+    Reference of the OPF <guide>
+    """
+    __slots__ = ("href", "type", "title", "element")
+
+    def __init__(self, element):
+        self.href = element.get("href")
+        self.type = element.get("type")
+        self.title = element.get("title")
+        self.element = element
+
+    def as_dict(self):
+        return {"href": self.href, "type": self.type, "title": self.title}
+
+
+class Manifest(object):
+    """
+    Indexed view of the OPF manifest, spine and guide.
+    Items are looked up by id, href and media type in constant time; EPUB keeps
+    the index and the OPF tree in sync when items are added or deleted.
+    """
+
+    def __init__(self, opf):
+        """
+        :type opf: Element
+        :param opf: OPF tree
+        """
+        self.manifest_element = opf.find("{0}manifest".format(NAMESPACE["opf"]))
+        self.spine_element = opf.find("{0}spine".format(NAMESPACE["opf"]))
+        self.guide_element = opf.find("{0}guide".format(NAMESPACE["opf"]))  # The guide element is optional
+        self.by_id = collections.OrderedDict()
+        self.by_href = {}
+        self.by_type = {}
+        for x in self.manifest_element:
+            if x.get("id"):
+                self._index(ManifestItem(x))
+        self.spine = [SpineItem(x) for x in self.spine_element if x.get("idref")]
+        self.by_idref = dict((x.idref, x) for x in self.spine)
+        if self.guide_element is None:
+            self.guide = None
+        else:
+            self.guide = [GuideItem(x) for x in self.guide_element if x.get("href")]
+
+    def _index(self, item):
+        self.by_id[item.id] = item
+        self.by_href[item.href] = item
+        self.by_type.setdefault(item.mimetype, []).append(item)
+
+    @property
+    def items(self):
+        """
+        Manifest items, in document order
+        """
+        return self.by_id.values()
+
+    @property
+    def toc(self):
+        """
+        Manifest item of the NCX, or None
+        """
+        return self.by_id.get(self.spine_element.get("toc"))
+
+    def add(self, element):
+        """
+        Append an <item> to the manifest
+
+        :type element: Element
+        :param element: the new <item>
+        :rtype: ManifestItem
+        """
+        item = ManifestItem(element)
+        self.manifest_element.append(element)
+        self._index(item)
+        return item
+
+    def insert_itemref(self, position, element):
+        """
+        Insert an <itemref> in the spine, append it if position is None or past the end
+
+        :type position: int
+        :param position: order in spine
+        :type element: Element
+        :param element: the new <itemref>
+        """
+        item = SpineItem(element)
+        if position is None or position > len(self.spine_element):
+            self.spine_element.append(element)
+            self.spine.append(item)
+        else:
+            self.spine_element.insert(position, element)
+            self.spine.insert(position, item)
+        self.by_idref[item.idref] = item
+
+    def insert_reference(self, position, element):
+        """
+        Insert a <reference> in the guide, append it if position is None or past the end
+
+        :type position: int
+        :param position: order in guide
+        :type element: Element
+        :param element: the new <reference>
+        """
+        item = GuideItem(element)
+        if position is None or position >= len(self.guide_element):
+            self.guide_element.append(element)
+            self.guide.append(item)
+        else:
+            self.guide_element.insert(position, element)
+            self.guide.insert(position, item)
+
+    def remove(self, item):
+        """
+        Drop a manifest item, along with its spine and guide references
+
+        :type item: ManifestItem
+        :param item: item to be removed
+        """
+        self.manifest_element.remove(item.element)
+        del self.by_id[item.id]
+        del self.by_href[item.href]
+        self.by_type[item.mimetype].remove(item)
+        itemref = self.by_idref.pop(item.id, None)
+        if itemref is not None:
+            self.spine_element.remove(itemref.element)
+            self.spine.remove(itemref)
+        if self.guide:
+            for reference in [x for x in self.guide if x.href.split("#")[0] == item.href]:
+                self.guide_element.remove(reference.element)
+                self.guide.remove(reference)
+
+    def remove_all(self, items):
+        """
+        Drop many manifest items at once, along with their spine and guide references, in linear time
+
+        :type items: [ManifestItem]
+        :param items: items to be removed
+        """
+        ids = set(x.id for x in items)
+        hrefs = set(x.href for x in items)
+        self.manifest_element[:] = [x for x in self.manifest_element if x.get("id") not in ids]
+        for item in items:
+            del self.by_id[item.id]
+            del self.by_href[item.href]
+        for mediatype in set(x.mimetype for x in items):
+            self.by_type[mediatype] = [x for x in self.by_type[mediatype] if x.id not in ids]
+        self.set_spine([x for x in self.spine_element if x.get("idref") not in ids])
+        if self.guide:
+            self.set_guide([x for x in self.guide_element if (x.get("href") or "").split("#")[0] not in hrefs])
+
+    def set_spine(self, elements):
+        """
+        Replace the children of <spine>
+
+        :type elements: [Element]
+        :param elements: the new children, in order
+        """
+        self.spine_element[:] = elements
+        self.spine = [SpineItem(x) for x in self.spine_element if x.get("idref")]
+        self.by_idref = dict((x.idref, x) for x in self.spine)
+
+    def set_guide(self, elements):
+        """
+        Replace the children of <guide>
+
+        :type elements: [Element]
+        :param elements: the new children, in order
+        """
+        self.guide_element[:] = elements
+        self.guide = [GuideItem(x) for x in self.guide_element if x.get("href")]
+
+
+class Batch(object):
+    """
+    Queue of edits to an EPUB, applied in a single pass on commit(): spine and guide are rebuilt once,
+    NCX navPoints are generated for the new parts and playOrder is renumbered once, whatever the
+    number of operations. Positions refer to the spine as it was before the batch.
+
+        >>> with epub.batch() as batch:
+        ...     for chapter in chapters:
+        ...         batch.addpart(chapter.content, chapter.href, "application/xhtml+xml", title=chapter.title)
+    """
+
+    def __init__(self, epub):
+        assert epub.epub_mode != "r", "%s is not writable" % epub
+        self.epub = epub
+        self._items = []        # (payload, href, mediatype, id)
+        self._hrefs = set()     # hrefs and ids of the queued items
+        self._ids = set()
+        self._parts = []        # (id, href, position, reftype, linear, title)
+        self._metadata = []     # (term, value, namespace)
+        self._deletes = []      # archive paths
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def additem(self, fileObject, href, mediatype):
+        """
+        Queue a file to be added to the manifest only, see EPUB.additem()
+
+        :return: the manifest id the item will have
+        """
+        manifest = self.epub.manifest
+        if href in manifest.by_href or href in self._hrefs:
+            raise InvalidEpub("%s is already in the manifest" % href)
+        import uuid
+        fileid = "id_"+str(uuid.uuid4())[:5]
+        while fileid in manifest.by_id or fileid in self._ids:
+            fileid = "id_"+str(uuid.uuid4())[:5]
+        self._items.append((fileObject, href, mediatype, fileid))
+        self._hrefs.add(href)
+        self._ids.add(fileid)
+        return fileid
+
+    def addpart(self, fileObject, href, mediatype, position=None, reftype="text", linear="yes", title=None):
+        """
+        Queue a file to be added to manifest, spine, guide (if any) and NCX, see EPUB.addpart()
+
+        :type title: str
+        :param title: label of the NCX navPoint, href by default
+        :return: the manifest id the item will have
+        """
+        fileid = self.additem(fileObject, href, mediatype)
+        self._parts.append((fileid, href, position, reftype, linear, title or href))
+        return fileid
+
+    def addmetadata(self, term, value, namespace='dc'):
+        """
+        Queue a metadata entry, see EPUB.addmetadata()
+        """
+        self._metadata.append((term, value, namespace))
+
+    def delete(self, *paths):
+        """
+        Queue archive members to be deleted, see EPUB._delete(); deleting a queued item cancels it
+        """
+        for path in paths:
+            href = self.epub._href(path)
+            if href in self._hrefs:
+                cancelled = [x[3] for x in self._items if x[1] == href]
+                self._items = [x for x in self._items if x[1] != href]
+                self._parts = [x for x in self._parts if x[1] != href]
+                self._hrefs.discard(href)
+                self._ids.difference_update(cancelled)
+            else:
+                self._deletes.append(path)
+
+    def commit(self):
+        """
+        Apply every queued operation, then empty the queue
+        """
+        epub = self.epub
+        manifest = epub.manifest
+
+        # Payloads and manifest items
+        for fileObject, href, mediatype, fileid in self._items:
+            try:
+                payload = fileObject.getvalue().encode('utf-8')
+            except AttributeError:
+                payload = fileObject
+            epub._writestr(os.path.join(epub.root_folder, href), payload, mediatype)
+            manifest.add(ET.Element("item", attrib={"id": fileid, "href": href, "media-type": mediatype}))
+
+        # Spine and guide, merged in one pass over their current children
+        if self._parts:
+            spine = list(manifest.spine_element)
+            guide = list(manifest.guide_element) if manifest.guide else None
+            spine_inserts, guide_inserts = {}, {}
+            spine_tail, guide_tail = [], []
+            for fileid, href, position, reftype, linear, title in self._parts:
+                itemref = ET.Element("itemref", attrib={"idref": fileid, "linear": linear})
+                reference = ET.Element("reference", attrib={"title": href, "href": href, "type": reftype})
+                if position is None or position > len(spine):
+                    spine_tail.append(itemref)
+                    guide_tail.append(reference)
+                else:
+                    spine_inserts.setdefault(position, []).append(itemref)
+                    if guide is not None and len(guide) >= position+1:
+                        guide_inserts.setdefault(position, []).append(reference)
+            manifest.set_spine(self._merge(spine, spine_inserts, spine_tail))
+            if guide is not None:
+                manifest.set_guide(self._merge(guide, guide_inserts, guide_tail))
+
+        # Deletions
+        if self._deletes:
+            hrefs = set(epub._href(path) for path in self._deletes)
+            manifest.remove_all([manifest.by_href[x] for x in hrefs if x in manifest.by_href])
+            for path in self._deletes:
+                epub._write_files.pop(path, None)
+                if epub.member_cache is not None and epub.mode == "r":
+                    epub.member_cache.invalidate(epub, path)
+                if epub.epub_mode == "w":
+                    epub._unlist(path)
+            epub._delete_files.extend(self._deletes)
+
+        if self._parts or self._deletes:
+            self._navpoints()
+
+        for term, value, namespace in self._metadata:
+            epub.addmetadata(term, value, namespace)
+
+        epub.__dict__.pop("info", None)     # info and contents are rebuilt on next access
+        epub.__dict__.pop("contents", None)
+        self._items, self._parts, self._metadata, self._deletes = [], [], [], []
+        self._hrefs, self._ids = set(), set()
+
+    @staticmethod
+    def _merge(children, inserts, tail):
+        """
+        children, with inserts[i] placed before children[i], and tail at the end
+        """
+        merged = []
+        for i, child in enumerate(children):
+            merged.extend(inserts.get(i, ()))
+            merged.append(child)
+        merged.extend(inserts.get(len(children), ()))
+        merged.extend(tail)
+        return merged
+
+    def _navpoints(self):
+        """
+        Add a top-level navPoint for each new part, in spine order, drop the navPoints
+        of deleted members, then renumber playOrder
+        """
+        epub = self.epub
+        manifest = epub.manifest
+        navmap = epub.ncx.find("{0}navMap".format(NAMESPACE["ncx"]))
+        if navmap is None:
+            return
+        ncx_folder = os.path.dirname(epub.ncx_path)
+
+        def target(point):
+            content = point.find("{0}content".format(NAMESPACE["ncx"]))
+            if content is None:
+                return None
+            return os.path.normpath(os.path.join(ncx_folder, content.get("src", "").split("#")[0]))
+
+        if self._deletes:
+            epub._prune_navpoints(self._deletes)
+
+        order = {}      # archive path -> position in the new spine
+        for i, itemref in enumerate(manifest.spine):
+            item = manifest.by_id.get(itemref.idref)
+            if item is not None:
+                order[os.path.normpath(os.path.join(epub.root_folder, item.href))] = i
+
+        new_points = []
+        for fileid, href, position, reftype, linear, title in self._parts:
+            path = os.path.join(epub.root_folder, href)
+            if os.path.normpath(path) not in order:
+                continue    # no longer in the spine
+            point = ET.Element("{0}navPoint".format(NAMESPACE["ncx"]), attrib={"id": "navPoint-" + fileid})
+            label = ET.SubElement(point, "{0}navLabel".format(NAMESPACE["ncx"]))
+            ET.SubElement(label, "{0}text".format(NAMESPACE["ncx"])).text = title
+            ET.SubElement(point, "{0}content".format(NAMESPACE["ncx"]),
+                          attrib={"src": os.path.relpath(path, ncx_folder) if ncx_folder else path})
+            new_points.append((order[os.path.normpath(path)], point))
+        new_points.sort(key=lambda x: x[0], reverse=True)   # next one to be placed is at the end
+
+        merged = []
+        for child in navmap:
+            position = order.get(target(child))
+            while new_points and position is not None and new_points[-1][0] < position:
+                merged.append(new_points.pop()[1])
+            merged.append(child)
+        merged.extend(x[1] for x in reversed(new_points))
+        navmap[:] = merged
+
+        for i, point in enumerate(epub.ncx.iter("{0}navPoint".format(NAMESPACE["ncx"]))):
+            point.set("playOrder", str(i + 1))
+
+
 class EPUB(zipfile.ZipFile):
     """
     EPUB file representation class.
     """
     
-    def __init__(self, filename, mode="r"):
+    def __init__(self, filename, mode="r", spool_size=SPOOL_SIZE, lazy=False, cache=None, observer=None,
+                 compression=None, member_cache=None):
         """
         Global Init Switch
 
         :type filename: str or StringIO() or file like object for read or add
         :param filename: File to be processed
         :type mode: str
-        :param mode: "w" or "r", mode to init the zipfile
+        :param mode: "w", "r" or "a", mode to init the zipfile
+        :type spool_size: int
+        :param spool_size: bytes of pending writes held in memory before spilling to a temporary file
+        :type lazy: bool
+        :param lazy: defer OPF and NCX parsing until info, id, cover, contents... are first accessed
+        :type cache: pyepub.cache.MetadataCache
+        :param cache: persistent cache of parsed metadata, "r" and "a" modes only
+        :type observer: callable
+        :param observer: called as observer(phase, seconds, bytes_read, bytes_written, members)
+                         at the end of each phase of reading and writing, see Stats
+        :type compression: CompressionPolicy
+        :param compression: how new and rewritten members are compressed, CompressionPolicy() by default
+        :type member_cache: pyepub.cache.MemberCache
+        :param member_cache: in-memory cache of decompressed members and parsed trees, may be shared across EPUBs
         """
-        self._write_files = {}  # a dict of files written to the archive  
+        self.observer = observer
+        self.member_cache = member_cache
+        self.compression_policy = compression or CompressionPolicy()
+        # files written to the archive, in the order they were added: path -> (offset, size, crc, mediatype)
+        self._write_files = collections.OrderedDict()
         self._delete_files = [] # a list of files to delete from the archive
+        self._spool_size = spool_size
+        self._source = None     # file object opened by EPUB itself, to be closed along with the archive
         self.epub_mode = mode
         self.writename = None
         if mode == "w":
+            # members are streamed to the target as they are added, opf & ncx are written on close()
             if isinstance(filename, str):
-                self.writename = open(filename, "w")  # on close, we'll overwrite on this file
+                self._source = open(filename, "w+b")
+                self.writename = self._source
             else:
                 # filename is already a file like object
                 self.writename = filename
-            dummy= StringIO()
-            zipfile.ZipFile.__init__(self, dummy, mode="w")  # fake
+            zipfile.ZipFile.__init__(self, self.writename, mode="w")
             self.__init__write()
         elif mode == "a":
-            # we're not going to write to the file until the very end
+            # we're not going to write to the file until the very end:
+            # the original archive is read in place, never copied in memory
             if isinstance(filename, str):
-                self.filename = open(filename, "w")  # on close, we'll overwrite on this file
+                self._source = open(filename, "rb")
+                source = self._source
             else:
                 # filename is already a file like object
-                self.filename = filename
-            self.filename.seek(0)
-            temp = StringIO()
-            temp.write(self.filename.read())
-            zipfile.ZipFile.__init__(self, self.filename, mode="r") # r mode doesn't set the filename
-            self.__init__read(temp)
+                source = filename
+            source.seek(0)
+            zipfile.ZipFile.__init__(self, source, mode="r")
+            self.__init__read(filename, lazy, cache)
         else:  # retrocompatibility?
             zipfile.ZipFile.__init__(self, filename, mode="r")
-            self.__init__read(filename)
+            self.__init__read(filename, lazy, cache)
 
-    def __init__read(self, filename):
+    def __init__read(self, filename, lazy=False, cache=None):
         """
         Constructor to initialize the zipfile in read-only mode
 
         :type filename: str or StringIO()
         :param filename: File to be processed
+        :type lazy: bool
+        :param lazy: if True, only container.xml is read here; everything else is parsed on first access
+        :type cache: pyepub.cache.MetadataCache
+        :param cache: if a cached entry matches this file, no XML is parsed at all
         """
         self.filename = filename
-        try:
-            # Read the container
-            f = self.read("META-INF/container.xml")
-        except KeyError:
-            # By specification, there MUST be a container.xml in EPUB
-            print "The %s file is not a valid OCF." % str(filename)
-            raise InvalidEpub
-        try:
-            # There MUST be a full path attribute on first grandchild...
-            self.opf_path = ET.fromstring(f)[0][0].get("full-path")
-        except IndexError:
-            #  ...else the file is invalid.
-            print "The %s file is not a valid OCF." % str(filename)
-            raise InvalidEpub
-
-        # NEW: json-able info tree
-        self.info = {"metadata": {},
-                     "manifest": [],
-                     "spine": [],
-                     "guide": []}
+        if cache is not None:
+            with self._phase("cache") as phase:
+                key = cache.key(self)
+                if cache.load(key, self):
+                    phase.add(members=1)
+                    return
+        with self._phase("container") as phase:
+            try:
+                # Read the container
+                f = self.read("META-INF/container.xml")
+            except KeyError:
+                # By specification, there MUST be a container.xml in EPUB
+                raise InvalidEpub("The %s file is not a valid OCF." % str(filename))
+            rootfile = ROOTFILE_RE.search(f)
+            if rootfile is not None:
+                self.opf_path = rootfile.group(2)
+            else:
+                try:
+                    # There MUST be a full path attribute on first grandchild...
+                    self.opf_path = ET.fromstring(f)[0][0].get("full-path")
+                except IndexError:
+                    #  ...else the file is invalid.
+                    raise InvalidEpub("The %s file is not a valid OCF." % str(filename))
+            phase.add(read=len(f), members=1)
 
         self.root_folder = os.path.dirname(self.opf_path)   # Used to compose absolute paths for reading in zip archive
-        self.opf = ET.fromstring(self.read(self.opf_path))  # OPF tree
 
-        ns = re.compile(r'\{.*?\}')  # RE to strip {namespace} mess
+        if cache is not None:
+            cache.store(key, self)
+        elif not lazy:
+            # Build everything right away: OPF metadata, manifest, spine, guide, and the NCX
+            self.info
+            self.id
+            self.contents
 
-        # Iterate over <metadata> section, fill EPUB.info["metadata"] dictionary
-        for i in self.opf.find("{0}metadata".format(NAMESPACE["opf"])):
-            tag = ns.sub('', i.tag)
-            if tag not in self.info["metadata"]:
-                self.info["metadata"][tag] = i.text or i.attrib
+    def _parse_metadata(self):
+        """
+        Fill EPUB.metadata, EPUB.id and EPUB.cover from the OPF <metadata> section.
+        If the OPF tree hasn't been built yet, the OPF is parsed incrementally and
+        the parser stops as soon as </metadata> is reached.
+        """
+        if "opf" in self.__dict__:
+            uid = self.opf.get("unique-identifier")
+            section = self.opf.find("{0}metadata".format(NAMESPACE["opf"]))
+        else:
+            uid = section = None
+            with self._phase("metadata") as phase:
+                stream = self.open(self.opf_path)
+                try:
+                    for event, element in ET.iterparse(stream, events=("start", "end")):
+                        if event == "start":
+                            if uid is None:     # first start event is the <package> element
+                                uid = element.get("unique-identifier") or ""
+                        elif element.tag == "{0}metadata".format(NAMESPACE["opf"]):
+                            section = element
+                            break
+                finally:
+                    stream.close()
+                phase.add(members=1)
+        if section is None:
+            raise InvalidEpub("Cannot process an EPUB without metadata section in the package element")
+
+        # Iterate over <metadata> section, fill EPUB.metadata dictionary
+        metadata = {}
+        for i in section:
+            tag = NAMESPACE_RE.sub('', i.tag)
+            if tag not in metadata:
+                metadata[tag] = i.text or i.attrib
             else:
-                self.info["metadata"][tag] = [self.info["metadata"][tag], i.text or i.attrib]
+                metadata[tag] = [metadata[tag], i.text or i.attrib]
+        self.metadata = metadata
 
         # Get id of the cover in <meta name="cover" />
         try:
-            coverid = self.opf.find('.//{0}meta[@name="cover"]'.format(NAMESPACE["opf"])).get("content")
+            coverid = section.find('.//{0}meta[@name="cover"]'.format(NAMESPACE["opf"])).get("content")
         except AttributeError:
             # It's a facultative field, after all
             coverid = None
         self.cover = coverid  # This is the manifest ID of the cover
 
-        self.info["manifest"] = [{"id": x.get("id"),                # Build a list of manifest items
-                                  "href": x.get("href"),
-                                  "mimetype": x.get("media-type")}
-                                 for x in self.opf.find("{0}manifest".format(NAMESPACE["opf"])) if x.get("id")]
+        # Document identifier
+        identifier = section.find('.//{0}identifier[@id="{1}"]'.format(NAMESPACE["dc"], uid))
+        if identifier is not None:
+            self.id = identifier.text
 
-        self.info["spine"] = [{"idref": x.get("idref")}             # Build a list of spine items
-                              for x in self.opf.find("{0}spine".format(NAMESPACE["opf"])) if x.get("idref")]
-        try:
-            self.info["guide"] = [{"href": x.get("href"),           # Build a list of guide items
-                                   "type": x.get("type"),
-                                   "title": x.get("title")}
-                                  for x in self.opf.find("{0}guide".format(NAMESPACE["opf"])) if x.get("href")]
-        except TypeError:                                           # The guide element is optional
-            self.info["guide"] = None
+    @_lazy
+    def metadata(self):
+        """
+        OPF metadata entries, by tag name
+        """
+        self._parse_metadata()
+        return self.__dict__["metadata"]
 
-        # Document identifier
+    @_lazy
+    def cover(self):
+        """
+        Manifest ID of the cover, or None
+        """
+        self._parse_metadata()
+        return self.__dict__["cover"]
+
+    @_lazy
+    def id(self):
+        """
+        Unique identifier of the publication
+        """
+        if "metadata" not in self.__dict__:
+            self._parse_metadata()
         try:
-            self.id = self.opf.find('.//{0}identifier[@id="{1}"]'.format(NAMESPACE["dc"],
-                                                                         self.opf.get("unique-identifier"))).text
-        except AttributeError:
+            return self.__dict__["id"]
+        except KeyError:
             raise InvalidEpub("Cannot process an EPUB without unique-identifier attribute of the package element")
-        # Get and parse the TOC
-        toc_id = self.opf[2].get("toc")
-        expr = ".//{0}item[@id='{1:s}']".format(NAMESPACE["opf"], toc_id)
-        toc_name = self.opf.find(expr).get("href")
-        self.ncx_path = os.path.join(self.root_folder, toc_name)
-        self.ncx = ET.fromstring(self.read(self.ncx_path))
-        self.contents = [{"name": i[0][0].text or "None",           # Build a list of toc elements
-                          "src": os.path.join(self.root_folder, i[1].get("src")),
-                          "id":i.get("id")}
-                         for i in self.ncx.iter("{0}navPoint".format(NAMESPACE["ncx"]))]    # The iter method
-                                                                                            # loops over nested
-                                                                                                  
+
+    @_lazy
+    def opf(self):
+        """
+        OPF tree
+        """
+        with self._phase("opf") as phase:
+            data = self.read(self.opf_path)
+            phase.add(read=len(data), members=1)
+            return ET.fromstring(data)
+
+    @_lazy
+    def info(self):
+        """
+        json-able info tree
+        """
+        manifest = self.manifest
+        info = {"metadata": self.metadata,
+                "manifest": [x.as_dict() for x in manifest.items],
+                "spine": [x.as_dict() for x in manifest.spine]}
+        if manifest.guide is None:                                  # The guide element is optional
+            info["guide"] = None
+        else:
+            info["guide"] = [x.as_dict() for x in manifest.guide]
+        return info
+
+    @_lazy
+    def manifest(self):
+        """
+        Indexed manifest, spine and guide
+        """
+        return Manifest(self.opf)
+
+    @_lazy
+    def ncx_path(self):
+        """
+        Path of the NCX inside the archive
+        """
+        return os.path.join(self.root_folder, self.manifest.toc.href)
+
+    @_lazy
+    def ncx(self):
+        """
+        NCX tree
+        """
+        with self._phase("ncx") as phase:
+            data = self.read(self.ncx_path)
+            phase.add(read=len(data), members=1)
+            return ET.fromstring(data)
+
+    @_lazy
+    def contents(self):
+        """
+        json-able list of toc elements
+        """
+        return [{"name": i[0][0].text or "None",                    # Build a list of toc elements
+                 "src": os.path.join(self.root_folder, i[1].get("src")),
+                 "id":i.get("id")}
+                for i in self.ncx.iter("{0}navPoint".format(NAMESPACE["ncx"]))]     # The iter method
+                                                                                    # loops over nested
+
+    def itertext(self, threads=None, errors=None):
+        """
+        Iterate over the text of the documents in the spine, in spine order, without ever building
+        a whole document tree. With threads, documents are parsed ahead in a thread pool; the
+        archive must then have been opened by name, so that each thread can read on its own.
+
+        :type threads: int
+        :param threads: number of documents parsed concurrently, None to parse in the calling thread
+        :type errors: list
+        :param errors: if given, a document that is missing or can't be parsed is appended to it as
+                       {"idref": ..., "href": ..., "error": ...} once the text found up to the error
+                       has been yielded, and iteration goes on with the next one; else InvalidEpub is raised
+        :return: iterator of (idref, href, text_chunk) tuples
+        """
+        chapters = [(x.idref, self.manifest.by_id[x.idref].href)
+                    for x in self.manifest.spine if x.idref in self.manifest.by_id]
+        if not threads or not isinstance(self.filename, basestring):
+            for idref, href in chapters:
+                try:
+                    stream = self.open(self._resolve(href, self.root_folder))
+                    try:
+                        for chunk in _itertext(stream):
+                            yield idref, href, chunk
+                    finally:
+                        stream.close()
+                except (KeyError, SyntaxError) as e:    # ParseError is a SyntaxError
+                    self._texterror(idref, href, e, errors)
+            return
+
+        import threading
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        handles = threading.local()     # one archive handle per worker thread
+        opened = []
+        pending = collections.deque()   # at most 2 * threads parsed documents are held in memory
+        try:
+            for idref, href in chapters:
+                pending.append((idref, href, pool.apply_async(self._chaptertext, (href, handles, opened))))
+                if len(pending) >= 2 * threads:
+                    idref, href, result = pending.popleft()
+                    chunks, error = result.get()
+                    for chunk in chunks:
+                        yield idref, href, chunk
+                    if error is not None:
+                        self._texterror(idref, href, error, errors)
+            while pending:
+                idref, href, result = pending.popleft()
+                chunks, error = result.get()
+                for chunk in chunks:
+                    yield idref, href, chunk
+                if error is not None:
+                    self._texterror(idref, href, error, errors)
+        finally:
+            pool.terminate()
+            for archive in opened:
+                archive.close()
+
+    def _chaptertext(self, href, handles, opened):
+        """
+        Text chunks of a single document, read through the calling thread's own handle on the archive
+
+        :type href: str
+        :param href: manifest href of the document
+        :type handles: threading.local
+        :param handles: its archive attribute is the calling thread's handle, opened on first use
+        :type opened: list
+        :param opened: handles opened so far, to be closed by the caller
+        :return: (text chunks, None) or, if the document is missing or broken, (text chunks up to the error, error)
+        """
+        archive = getattr(handles, "archive", None)
+        if archive is None:
+            archive = handles.archive = zipfile.ZipFile(self.filename)
+            opened.append(archive)
+        chunks = []
+        try:
+            stream = archive.open(self._resolve(href, self.root_folder))
+            try:
+                chunks.extend(_itertext(stream))
+            finally:
+                stream.close()
+        except (KeyError, SyntaxError) as e:
+            return chunks, e
+        return chunks, None
+
+    @staticmethod
+    def _texterror(idref, href, error, errors):
+        """
+        Report a document itertext() couldn't read, see its errors parameter
+        """
+        if errors is None:
+            raise InvalidEpub("Can't extract the text of %s: %s" % (href, error))
+        errors.append({"idref": idref, "href": href, "error": str(error)})
+
+    def verify(self, threads=None):
+        """
+        Check the CRC of every member, and that the manifest, spine, guide, NCX and cover
+        only refer to members that exist. With threads, CRCs are checked in a thread pool;
+        the archive must then have been opened by name, so that each thread can read on its own.
+
+        :type threads: int
+        :param threads: number of threads checking CRCs, None to check them in the calling thread
+        :rtype: dict
+        :return: {"ok": bool, "members": number of members checked,
+                  "crc": [{"name": ..., "error": ...}],
+                  "missing": [{"kind": "manifest"|"guide"|"ncx", "ref": href, "path": ...}],
+                  "dangling": [{"kind": "spine"|"toc"|"cover", "ref": id}]}
+        """
+        with self._phase("verify") as phase:
+            names = [x.filename for x in self.infolist() if x.filename not in self._delete_files]
+            if not threads or not isinstance(self.filename, basestring):
+                crc = self._crcerrors(names, self)
+            else:
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(threads)
+                try:
+                    chunks = [names[i::threads] for i in range(threads)]
+                    crc = sum(pool.map(self._crcerrors, chunks), [])
+                finally:
+                    pool.terminate()
+            phase.add(read=sum(self.getinfo(x).compress_size for x in names), members=len(names))
+
+            existing = set(names) | set(self._write_files)
+            manifest = self.manifest
+            missing, dangling = [], []
+
+            def check(kind, href, base=self.root_folder):
+                path = self._resolve(href, base)
+                if path not in existing:
+                    missing.append({"kind": kind, "ref": href, "path": path})
+
+            for item in manifest.items:
+                check("manifest", item.href)
+            for item in manifest.guide or []:
+                check("guide", item.href)
+            dangling.extend({"kind": "spine", "ref": x.idref} for x in manifest.spine if x.idref not in manifest.by_id)
+            if manifest.toc is None:
+                if manifest.spine_element.get("toc") is not None:
+                    dangling.append({"kind": "toc", "ref": manifest.spine_element.get("toc")})
+            elif self.ncx_path in existing:
+                for content in self.ncx.iter("{0}content".format(NAMESPACE["ncx"])):
+                    check("ncx", content.get("src"), posixpath.dirname(self.ncx_path))   # relative to the NCX
+            if self.cover is not None and self.cover not in manifest.by_id:
+                dangling.append({"kind": "cover", "ref": self.cover})
+
+            crc.sort(key=lambda x: x["name"])
+            return {"ok": not (crc or missing or dangling), "members": len(names),
+                    "crc": crc, "missing": missing, "dangling": dangling}
+
+    def _crcerrors(self, names, archive=None):
+        """
+        Read members to the end, which checks their CRC; through a private handle on the archive, if none is given
+
+        :type names: list
+        :param names: members to be checked
+        :rtype: list
+        """
+        errors = []
+        own = archive is None
+        if own:
+            archive = zipfile.ZipFile(self.filename)
+        try:
+            for name in names:
+                try:
+                    stream = zipfile.ZipFile.open(archive, name)
+                    try:
+                        while stream.read(COPY_CHUNK_SIZE):
+                            pass
+                    finally:
+                        stream.close()
+                except (zipfile.BadZipfile, zlib.error) as e:
+                    errors.append({"name": name, "error": str(e)})
+        finally:
+            if own:
+                archive.close()
+        return errors
+
+    @staticmethod
+    def _resolve(href, base):
+        """
+        Archive path of a relative href, without fragment and percent-encoding
+
+        :type href: str
+        :param href: href or src attribute
+        :type base: str
+        :param base: folder the href is relative to
+        """
+        import urllib
+        href = urllib.unquote(href.split("#", 1)[0])
+        return posixpath.normpath(posixpath.join(base, href))
+
     def __init__write(self):
         """
         Init an empty EPUB
@@ -159,6 +1106,7 @@ class EPUB(zipfile.ZipFile):
         self.opf_path = "OEBPS/content.opf"  # Define a default folder for contents
         self.ncx_path = "OEBPS/toc.ncx"
         self.root_folder = "OEBPS"
+        import uuid
         self.uid = '%s' % uuid.uuid4()
 
         self.info = {"metadata": {},
@@ -169,26 +1117,29 @@ class EPUB(zipfile.ZipFile):
         self.info["metadata"]["creator"] = "py-clave server"
         self.info["metadata"]["title"] = ""
         self.info["metadata"]["language"] = ""
+        self.metadata = self.info["metadata"]
+        self.id = self.uid
+        self.cover = None
+        self.contents = []
 
         self.opf = ET.fromstring(self._init_opf())  # opf property is always a ElementTree
         self.ncx = ET.fromstring(self._init_ncx())  # so is ncx. Consistent with self.(opf|ncx) built by __init_read()
 
-        self.writestr(self.opf_path, ET.tostring(self.opf, encoding="UTF-8"))  # temporary opf & ncx
-        self.writestr(self.ncx_path, ET.tostring(self.ncx, encoding="UTF-8"))  # will be re-init on close()
+        self.writestr('mimetype', "application/epub+zip")  # must be the first member of the archive
 
     @property
     def author(self):
-        return self.info["metadata"]["creator"]
+        return self.metadata["creator"]
 
     @author.setter
     def author(self, value):
         tmp = self.opf.find(".//{0}creator".format(NAMESPACE["dc"]))
         tmp.text = value
-        self.info["metadata"]["creator"] = value
+        self.metadata["creator"] = value
 
     @property
     def title(self):
-        return self.info["metadata"]["title"]
+        return self.metadata["title"]
 
     @title.setter
     def title(self, value):
@@ -196,30 +1147,121 @@ class EPUB(zipfile.ZipFile):
         tmp.text = value
         ncx_title = self.ncx.find("{http://www.daisy.org/z3986/2005/ncx/}docTitle")[0]
         ncx_title.text = value
-        self.info["metadata"]["title"] = value
+        self.metadata["title"] = value
 
     @property
     def language(self):
-        return self.info["metadata"]["language"]
+        return self.metadata["language"]
 
     @language.setter
     def language(self, value):
         tmp = self.opf.find(".//{0}language".format(NAMESPACE["dc"]))
         tmp.text = value
-        self.info["metadata"]["language"] = value
+        self.metadata["language"] = value
 
     def close(self):
         if self.fp is None:     # Check file status
             return
         if self.mode == "r":    # check file mode
+            # The mapping is left to the garbage collector: views handed out by memberview() may still point into it
+            self.__dict__.pop("_map", None)
             zipfile.ZipFile.close(self)
-            return
         else:
             try:
                 self._safeclose()
                 zipfile.ZipFile.close(self)     # give back control to superclass close method
             except RuntimeError:            # zipfile.__del__ destructor calls close(), ignore
                 return
+        if "_spool" in self.__dict__:
+            self._spool.close()
+        if self._source is not None:
+            self._source.close()
+
+    def save(self):
+        """
+        Incremental save, for archives opened by name in "a" mode. Only new or changed members
+        (the OPF, the NCX, added parts) are written, after the existing data, followed by a
+        fresh central directory: untouched members are neither copied nor moved. Superseded
+        members are left behind as dead space, see compact().
+        """
+        assert self.epub_mode == "a" and self._source is not None, \
+            "%s: only archives opened by name in append mode can be saved in place" % self
+        with self._phase("save") as phase:
+            # container.xml never changes in append mode; the OPF and NCX are left alone if identical
+            package = [(path, data, mediatype) for path, data, mediatype in self._package()[1:]
+                       if path not in self.NameToInfo or
+                       self.NameToInfo[path].CRC != zipfile.crc32(data) & 0xffffffff]
+            replaced = set(self._write_files) | set(self._delete_files) | set(x[0] for x in package)
+            target = open(self._source.name, "r+b")
+            try:
+                epub_zip = zipfile.ZipFile(target, "a")  # new members go where the central directory was
+                epub_zip.filelist = [x for x in epub_zip.filelist if x.filename not in replaced]
+                epub_zip.NameToInfo = dict((x.filename, x) for x in epub_zip.filelist)
+                epub_zip._didModify = True      # deletions alone still need a new central directory
+                for path, data, mediatype in package:
+                    self._write_data(epub_zip, path, data, mediatype)
+                    phase.add(written=len(data), members=1)
+                self._write_pending(epub_zip, self._write_files.keys(), phase)
+                epub_zip.close()
+                target.truncate()   # the new central directory may be shorter than the old one
+            finally:
+                target.close()
+        self._reload(reopen=False)
+
+    def deadspace(self):
+        """
+        Bytes of the archive taken by members that are no longer in the central directory,
+        e.g. superseded by save()
+        """
+        live = 0
+        for x in self.filelist:
+            # the extra field of the local header may differ from the central directory's: read it
+            self.fp.seek(x.header_offset)
+            live += self._data_offset(x, self.fp.read(zipfile.sizeFileHeader)) - x.header_offset + x.compress_size
+            if x.flag_bits & 0x08:
+                live += 16  # data descriptor
+        return max(self.start_dir - live, 0)
+
+    def compact(self, threshold=0.25):
+        """
+        Full rewrite of an archive opened by name in "a" mode, if its dead space is over
+        threshold. Pending edits are written along with the rest.
+
+        :type threshold: float
+        :param threshold: fraction of the file size taken by dead space that triggers the rewrite
+        :rtype: bool
+        :return: whether the archive was rewritten
+        """
+        assert self.epub_mode == "a" and self._source is not None, \
+            "%s: only archives opened by name in append mode can be compacted" % self
+        if self.deadspace() <= threshold * os.path.getsize(self._source.name):
+            return False
+        self.writetodisk(self._source.name)
+        self._reload(reopen=True)
+        return True
+
+    def _reload(self, reopen):
+        """
+        Re-read the central directory once the archive has been rewritten on disk, and drop pending edits
+
+        :type reopen: bool
+        :param reopen: True if the file has been replaced, rather than modified in place
+        """
+        if reopen:
+            self._source.close()
+            self._source = open(self._source.name, "rb")
+            self.fp = self._source
+        self.__dict__.pop("_map", None)
+        if self.member_cache is not None:
+            self.member_cache.invalidate(self)
+        self.__dict__.pop("_identity", None)
+        self.filelist = []
+        self.NameToInfo = {}
+        self._RealGetContents()
+        self._write_files = collections.OrderedDict()
+        self._delete_files = []
+        self._spool.seek(0)
+        self._spool.truncate()
 
     def _safeclose(self):
         """
@@ -227,7 +1269,11 @@ class EPUB(zipfile.ZipFile):
         Writes the empty or modified opf-ncx files before closing the zipfile
         """
         if self.epub_mode == 'w':
-            self.writetodisk(self.writename)
+            # every other member has already been streamed to the target
+            with self._phase("package") as phase:
+                for path, data, mediatype in self._package():
+                    self._write_data(self, path, data, mediatype)
+                    phase.add(written=len(data), members=1)
         else:
             self.writetodisk(self.filename)
 
@@ -238,17 +1284,299 @@ class EPUB(zipfile.ZipFile):
         :type epub_zip: an empty instance of zipfile.Zipfile, mode=w
         :param epub_zip: zip file to write
         """
-        epub_zip.writestr('mimetype', "application/epub+zip")       # requirement of epub container format
-        epub_zip.writestr('META-INF/container.xml', self._containerxml())
-        epub_zip.writestr(self.opf_path, ET.tostring(self.opf, encoding="UTF-8"))  
-        epub_zip.writestr(self.ncx_path, ET.tostring(self.ncx, encoding="UTF-8"))  
-        paths = ['mimetype','META-INF/container.xml',self.opf_path,self.ncx_path]+ self._write_files.keys() + self._delete_files
-        if self.epub_mode != 'w':
+        with self._phase("package") as phase:
+            epub_zip.writestr('mimetype', "application/epub+zip")       # requirement of epub container format
+            for path, data, mediatype in self._package():
+                self._write_data(epub_zip, path, data, mediatype)
+                phase.add(written=len(data), members=1)
+        # members not to be copied as they are; a set, as it is looked up once per member
+        paths = set(['mimetype', 'META-INF/container.xml', self.opf_path, self.ncx_path])
+        paths.update(self._write_files)
+        paths.update(self._delete_files)
+        with self._phase("copy") as phase:
             for item in self.infolist():
                 if item.filename not in paths:
-                    epub_zip.writestr(item.filename, self.read(item.filename))
-        for key in self._write_files.keys():
-            epub_zip.writestr(key, self._write_files[key])
+                    self._copy_member(epub_zip, item)
+                    phase.add(read=item.compress_size, written=item.compress_size, members=1)
+        with self._phase("pending") as phase:
+            self._write_pending(epub_zip, self._write_files.keys(), phase)
+
+    def _package(self):
+        """
+        Serialized container.xml, OPF and NCX, as (path, bytes, media type) tuples
+        """
+        return [('META-INF/container.xml', self._containerxml(), "application/xml"),
+                (self.opf_path, ET.tostring(self.opf, encoding="UTF-8"), "application/oebps-package+xml"),
+                (self.ncx_path, ET.tostring(self.ncx, encoding="UTF-8"), "application/x-dtbncx+xml")]
+
+    def _phase(self, name):
+        """
+        Timed phase, reported to the observer (if any)
+
+        :type name: str
+        :param name: phase name, as reported to the observer
+        """
+        if self.observer is None:
+            return _NULL_PHASE
+        return _Phase(self.observer, name)
+
+    def _copy_member(self, epub_zip, zinfo, filename=None):
+        """
+        Copies an untouched member to the specified zipfile, as is.
+        Compressed bytes, CRC and sizes are moved straight from the source archive,
+        so that the member is never decompressed nor recompressed.
+
+        :type epub_zip: an instance of zipfile.Zipfile, mode=w
+        :param epub_zip: zip file to write
+        :type zinfo: zipfile.ZipInfo
+        :param zinfo: member of the current archive to be copied
+        :type filename: str
+        :param filename: path of the copy, zinfo.filename by default
+        """
+        position = self.fp.tell()   # in "w" mode, self.fp is also where new members are streamed
+        self.fp.seek(zinfo.header_offset)
+        # Skip the local file name and extra field, we're writing our own
+        self.fp.seek(self._data_offset(zinfo, self.fp.read(zipfile.sizeFileHeader)))
+
+        new_info = zipfile.ZipInfo(filename or zinfo.filename, zinfo.date_time)
+        new_info.compress_type = zinfo.compress_type
+        new_info.comment = zinfo.comment
+        new_info.create_system = zinfo.create_system
+        new_info.external_attr = zinfo.external_attr
+        new_info.flag_bits = zinfo.flag_bits & ~0x08    # CRC and sizes are known: no data descriptor
+        new_info.CRC = zinfo.CRC
+        new_info.compress_size = zinfo.compress_size
+        new_info.file_size = zinfo.file_size
+        self._write_member(epub_zip, new_info, self.fp)
+        self.fp.seek(position)
+
+    @staticmethod
+    def _data_offset(zinfo, fheader):
+        """
+        Offset of the (compressed) data of a member in the archive
+
+        :type zinfo: zipfile.ZipInfo
+        :param zinfo: member of the archive
+        :type fheader: str or buffer
+        :param fheader: the zipfile.sizeFileHeader bytes found at zinfo.header_offset
+        """
+        fheader = struct.unpack(zipfile.structFileHeader, fheader)
+        if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile("Bad magic number for file header of %s" % zinfo.filename)
+        return (zinfo.header_offset + zipfile.sizeFileHeader +
+                fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+    @_lazy
+    def _spool(self):
+        """
+        Payload of pending writes, created on the first one
+        """
+        import tempfile
+        return tempfile.SpooledTemporaryFile(max_size=self._spool_size)
+
+    @_lazy
+    def _map(self):
+        """
+        Read-only memory map of the archive, or None if it isn't backed by a real file
+        """
+        try:
+            fileno = self.fp.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    def read(self, name, pwd=None):
+        """
+        Decompressed member, see zipfile.ZipFile.read(); through the member cache, if any
+
+        :type name: str or zipfile.ZipInfo
+        :param name: member of the archive
+        """
+        if self.member_cache is None or self.mode != "r":
+            return zipfile.ZipFile.read(self, name, pwd)
+        return self.member_cache.read(self, name, pwd)
+
+    def parse(self, name):
+        """
+        Parsed tree of an XML member; through the member cache, if any, in which case
+        the tree is shared and must not be modified
+
+        :type name: str
+        :param name: member of the archive
+        """
+        if self.member_cache is None or self.mode != "r":
+            return ET.fromstring(zipfile.ZipFile.read(self, name))
+        return self.member_cache.tree(self, name, ET.fromstring)
+
+    def memberview(self, name):
+        """
+        Access a member without copying it. Members stored uncompressed come as a memoryview over
+        the memory-mapped archive; deflated (or encrypted) members come as a file like object that
+        decompresses on read().
+
+        :type name: str or zipfile.ZipInfo
+        :param name: member of the archive
+        :return: memoryview or file like object
+        """
+        assert self.mode == "r", "%s is still being written" % self
+        zinfo = name if isinstance(name, zipfile.ZipInfo) else self.getinfo(name)
+        if zinfo.compress_type != zipfile.ZIP_STORED or zinfo.flag_bits & 0x1:
+            return self.open(zinfo)
+        if self._map is None:   # e.g. StringIO, no mapping: fall back to a copy
+            return memoryview(self.read(zinfo))
+        offset = self._data_offset(zinfo, buffer(self._map, zinfo.header_offset, zipfile.sizeFileHeader))
+        return memoryview(buffer(self._map, offset, zinfo.file_size))
+
+    def readrange(self, name, start, end=None):
+        """
+        Bytes [start:end) of a member, e.g. to answer HTTP range requests.
+        Stored members are sliced from the mapping without copies; deflated members
+        are decompressed up to end, and never held in memory as a whole.
+
+        :type name: str or zipfile.ZipInfo
+        :param name: member of the archive
+        :type start: int
+        :param start: first byte of the range
+        :type end: int
+        :param end: first byte past the range, None for the end of the member
+        :rtype: memoryview
+        """
+        view = self.memberview(name)
+        if isinstance(view, memoryview):
+            return view[start:end]
+        try:
+            while start > 0:    # there's no seeking in a deflate stream: decompress and drop
+                skipped = len(view.read(min(COPY_CHUNK_SIZE, start)))
+                if not skipped:
+                    break
+                start -= skipped
+                if end is not None:
+                    end -= skipped
+            if end is None:
+                return memoryview(view.read())
+            return memoryview(view.read(max(end, 0)))
+        finally:
+            view.close()
+
+    def _write_pending(self, epub_zip, paths, phase):
+        """
+        Copies pending writes from the spool to the specified zipfile, in order.
+        Stored members are copied in chunks; members to be deflated are compressed
+        ahead in a thread pool, if the compression policy says so.
+
+        :type epub_zip: an instance of zipfile.Zipfile, mode=w
+        :param epub_zip: zip file to write
+        :type paths: [str]
+        :param paths: paths of the pending files inside the EPUB archive
+        :type phase: _Phase
+        :param phase: where written bytes and members are accounted
+        """
+        policy = self.compression_policy
+        if policy.threads:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(policy.threads)
+        else:
+            pool = None
+        window = 2 * policy.threads if policy.threads else 1
+        pending = collections.deque()   # (path, compress type, data or deflate job)
+        try:
+            for path in paths:
+                offset, size, crc, mediatype = self._write_files[path]
+                compress_type = policy.compress_type(path, mediatype)
+                job = None
+                if compress_type == zipfile.ZIP_DEFLATED:
+                    self._spool.seek(offset)
+                    job = self._spool.read(size)
+                    if pool is not None:
+                        job = pool.apply_async(policy.compress, (job,))
+                pending.append((path, compress_type, job))
+                if len(pending) >= window:
+                    self._flush_pending(epub_zip, pending.popleft(), phase)
+            while pending:
+                self._flush_pending(epub_zip, pending.popleft(), phase)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _flush_pending(self, epub_zip, job, phase):
+        """
+        Writes one of the jobs queued by _write_pending()
+        """
+        path, compress_type, data = job
+        offset, size, crc, mediatype = self._write_files[path]
+        zinfo = self._zinfo(path, compress_type)
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        if compress_type == zipfile.ZIP_STORED:
+            zinfo.compress_size = size
+            self._spool.seek(offset)
+            source = self._spool
+        else:
+            if isinstance(data, str):
+                data = self.compression_policy.compress(data)
+            else:
+                data = data.get()
+            zinfo.compress_size = len(data)
+            source = StringIO(data)
+        self._write_member(epub_zip, zinfo, source)
+        phase.add(written=zinfo.compress_size, members=1)
+
+    def _write_data(self, epub_zip, path, data, mediatype=None):
+        """
+        Writes a new member to the specified zipfile, compressed according to the compression policy
+
+        :type epub_zip: an instance of zipfile.Zipfile, mode=w
+        :param epub_zip: zip file to write
+        :type path: str
+        :param path: path of the file inside the EPUB archive
+        :type data: str
+        :param data: file content
+        :type mediatype: str
+        :param mediatype: media type of the file, guessed from path if None
+        """
+        zinfo = self._zinfo(path, self.compression_policy.compress_type(path, mediatype))
+        zinfo.CRC = zipfile.crc32(data) & 0xffffffff
+        zinfo.file_size = len(data)
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            data = self.compression_policy.compress(data)
+        zinfo.compress_size = len(data)
+        self._write_member(epub_zip, zinfo, StringIO(data))
+
+    @staticmethod
+    def _zinfo(path, compress_type):
+        """
+        ZipInfo of a new member, timestamped now
+        """
+        zinfo = zipfile.ZipInfo(path, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o600 << 16
+        zinfo.compress_type = compress_type
+        return zinfo
+
+    @staticmethod
+    def _write_member(epub_zip, zinfo, source):
+        """
+        Writes the local header of zinfo, then zinfo.compress_size bytes read from source
+
+        :type epub_zip: an instance of zipfile.Zipfile, mode=w
+        :param epub_zip: zip file to write
+        :type zinfo: zipfile.ZipInfo
+        :param zinfo: member to be written, with CRC and sizes already set
+        :type source: file like object
+        :param source: positioned at the start of the (compressed) member data
+        """
+        zinfo.header_offset = epub_zip.fp.tell()
+        zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+        epub_zip.fp.write(zinfo.FileHeader(zip64))
+        remaining = zinfo.compress_size
+        while remaining > 0:
+            chunk = source.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipfile("Truncated data for %s" % zinfo.filename)
+            epub_zip.fp.write(chunk)
+            remaining -= len(chunk)
+        epub_zip._didModify = True
+        epub_zip.filelist.append(zinfo)
+        epub_zip.NameToInfo[zinfo.filename] = zinfo
 
     def _init_opf(self):
         """
@@ -256,6 +1584,7 @@ class EPUB(zipfile.ZipFile):
         :type return: xml.minidom.Document
         :return: xml.minidom.Document
         """
+        import datetime
         today = datetime.date.today()
         opf_tmpl = """<?xml version="1.0" encoding="utf-8" standalone="yes"?>
                         <package xmlns="http://www.idpf.org/2007/opf" unique-identifier="BookId" version="2.0">
@@ -327,8 +1656,91 @@ class EPUB(zipfile.ZipFile):
                 del self._write_files[path]
             except KeyError:
                 pass
+            if self.member_cache is not None and self.mode == "r":
+                self.member_cache.invalidate(self, path)
+            if self.epub_mode == "w":
+                self._unlist(path)
             self._delete_files.append(path)
+            if self.epub_mode != "r":
+                # The manifest item (and its spine & guide references) goes away too
+                item = self.manifest.by_href.get(self._href(path))
+                if item is not None:
+                    self.manifest.remove(item)
+                    self.__dict__.pop("info", None)     # info is rebuilt on next access
+        # and so do the NCX navPoints
+        if self.epub_mode != "r" and self.manifest.toc is not None and self.ncx_path not in self._delete_files:
+            if self._prune_navpoints(paths):
+                for i, point in enumerate(self.ncx.iter("{0}navPoint".format(NAMESPACE["ncx"]))):
+                    point.set("playOrder", str(i + 1))
+                self.__dict__.pop("contents", None)
+
+    def _prune_navpoints(self, paths):
+        """
+        Drop the NCX navPoints that point at deleted members, lifting their children in their place;
+        playOrder is left as it is
+
+        :type paths: [str]
+        :param paths: deleted files inside EPUB file
+        :rtype: bool
+        :return: whether any navPoint was dropped
+        """
+        navmap = self.ncx.find("{0}navMap".format(NAMESPACE["ncx"]))
+        if navmap is None:
+            return False
+        deleted = set(posixpath.normpath(x) for x in paths)
+        ncx_folder = posixpath.dirname(self.ncx_path)
+        tag = "{0}navPoint".format(NAMESPACE["ncx"])
+        dropped = []
+
+        def prune(parent):
+            children, changed = [], False
+            for child in parent:
+                if child.tag == tag:
+                    prune(child)
+                    content = child.find("{0}content".format(NAMESPACE["ncx"]))
+                    if content is not None and self._resolve(content.get("src", ""), ncx_folder) in deleted:
+                        dropped.append(child)
+                        children.extend(x for x in child if x.tag == tag)
+                        changed = True
+                        continue
+                children.append(child)
+            if changed:
+                parent[:] = children
+
+        prune(navmap)
+        return bool(dropped)
+
+    def _href(self, path):
+        """
+        Manifest href of an archive member
+
+        :type path: str
+        :param path: file inside EPUB file
+        """
+        if self.root_folder:
+            return os.path.relpath(path, self.root_folder)
+        return path
+
+    def _unlist(self, path):
+        """
+        Drop an already streamed member from the central directory ("w" mode only).
+        Its bytes are left in the archive, but no reader will ever look for them.
+
+        :type path: str
+        :param path: file inside EPUB file
+        """
+        zinfo = self.NameToInfo.pop(path, None)
+        if zinfo is not None:
+            self.filelist.remove(zinfo)
     
+    def batch(self):
+        """
+        Queue many edits and apply them in one pass, see Batch
+
+        :rtype: Batch
+        """
+        return Batch(self)
+
     def addmetadata(self, term, value, namespace='dc'):
         """
         Add an metadata entry 
@@ -346,13 +1758,23 @@ class EPUB(zipfile.ZipFile):
         element.text = value
         self.opf[0].append(element)
         # note that info is ignoring namespace entirely
-        if self.info["metadata"].has_key(term):
-            self.info["metadata"][term] = [self.info["metadata"][term] , value]
+        if self.metadata.has_key(term):
+            self.metadata[term] = [self.metadata[term] , value]
         else:
-            self.info["metadata"][term] = value
+            self.metadata[term] = value
     
-    def _writestr(self, filepath, filebytes):
-        self._write_files[filepath] = filebytes   
+    def _writestr(self, filepath, filebytes, mediatype=None):
+        if self.member_cache is not None and self.mode == "r":
+            self.member_cache.invalidate(self, filepath)
+        if self.epub_mode == "w":
+            # stream the member to the target right away
+            self._unlist(filepath)
+            self._write_data(self, filepath, filebytes, mediatype)
+            return
+        self._spool.seek(0, os.SEEK_END)    # overwritten entries are left behind as dead bytes
+        self._write_files[filepath] = (self._spool.tell(), len(filebytes), zipfile.crc32(filebytes) & 0xffffffff,
+                                       mediatype)
+        self._spool.write(filebytes)
         
     def additem(self, fileObject, href, mediatype):
         """
@@ -366,14 +1788,21 @@ class EPUB(zipfile.ZipFile):
         :param mediatype:
         """
         assert self.epub_mode != "r", "%s is not writable" % self
-        element = ET.Element("item",
-                             attrib={"id": "id_"+str(uuid.uuid4())[:5], "href": href, "media-type": mediatype})
+        if href in self.manifest.by_href:
+            raise InvalidEpub("%s is already in the manifest" % href)
+        import uuid
+        fileid = "id_"+str(uuid.uuid4())[:5]
+        while fileid in self.manifest.by_id:
+            fileid = "id_"+str(uuid.uuid4())[:5]
+        element = ET.Element("item", attrib={"id": fileid, "href": href, "media-type": mediatype})
 
         try:
-            self._writestr(os.path.join(self.root_folder, element.attrib["href"]), fileObject.getvalue().encode('utf-8'))
+            self._writestr(os.path.join(self.root_folder, element.attrib["href"]), fileObject.getvalue().encode('utf-8'),
+                           mediatype)
         except AttributeError:
-            self._writestr(os.path.join(self.root_folder, element.attrib["href"]), fileObject)
-        self.opf[1].append(element)
+            self._writestr(os.path.join(self.root_folder, element.attrib["href"]), fileObject, mediatype)
+        self.manifest.add(element)
+        self.__dict__.pop("info", None)     # info is rebuilt on next access
         return element.attrib["id"]
 
     def addpart(self, fileObject, href, mediatype, position=None, reftype="text", linear="yes"):
@@ -392,24 +1821,90 @@ class EPUB(zipfile.ZipFile):
         fileid = self.additem(fileObject, href, mediatype)
         itemref = ET.Element("itemref", attrib={"idref": fileid, "linear": linear})
         reference = ET.Element("reference", attrib={"title": href, "href": href, "type": reftype})
-        if position is None or position>len(self.opf[2]):
-            self.opf[2].append(itemref)
-            if self.info["guide"]:
-                self.opf[3].append(reference)
-        else:
-            self.opf[2].insert(position, itemref)
-            if self.info["guide"] and len(self.opf[3]) >= position+1:
-                self.opf[3].insert(position, reference) 
+        spine_length = len(self.manifest.spine_element)
+        self.manifest.insert_itemref(position, itemref)
+        if self.manifest.guide:
+            if position is None or position > spine_length:
+                self.manifest.insert_reference(None, reference)
+            elif len(self.manifest.guide_element) >= position+1:
+                self.manifest.insert_reference(position, reference)
                                                                                                   
     def writetodisk(self, filename):
         """
-        Writes the in-memory archive to disk
+        Writes the archive to disk. The output is built member by member, straight
+        into the target file: when the target is the file the EPUB was opened from,
+        it is built in a temporary file next to it and then moved over the original.
+        A file object the EPUB is read from is rewritten from a temporary copy once the
+        output is complete; the instance can't be read from anymore afterwards.
 
-        :type filename: str
-        :param filename: name of the file to be writte
+        :type filename: str or file like object
+        :param filename: name of the file to be written, or a writable file like object
         """
-        
-        filename.seek(0)
-        new_zip = zipfile.ZipFile(filename, 'w')
-        self._write_epub_zip(new_zip)
-        new_zip.close()
+        with self._phase("writetodisk") as phase:
+            if not isinstance(filename, basestring):
+                if not self._readsfrom(filename):
+                    filename.seek(0)
+                    new_zip = zipfile.ZipFile(filename, 'w')
+                    self._write_epub_zip(new_zip)
+                    new_zip.close()
+                    phase.add(written=filename.tell(), members=len(new_zip.filelist))
+                    return
+                import shutil
+                import tempfile
+                with tempfile.TemporaryFile() as output:
+                    new_zip = zipfile.ZipFile(output, 'w')
+                    self._write_epub_zip(new_zip)
+                    new_zip.close()
+                    phase.add(written=output.tell(), members=len(new_zip.filelist))
+                    output.seek(0)
+                    filename.seek(0)
+                    filename.truncate()
+                    shutil.copyfileobj(output, filename, COPY_CHUNK_SIZE)
+                return
+
+            target = os.path.realpath(filename)
+            if target == self._sourcepath():
+                import tempfile
+                output = tempfile.NamedTemporaryFile(dir=os.path.dirname(target), delete=False)
+            else:
+                output = open(target, "wb")
+            try:
+                new_zip = zipfile.ZipFile(output, 'w')
+                self._write_epub_zip(new_zip)
+                new_zip.close()
+                phase.add(written=output.tell(), members=len(new_zip.filelist))
+            except:
+                output.close()
+                if output.name != target:
+                    os.remove(output.name)
+                raise
+            output.close()
+            if output.name != target:
+                # the temporary file is created 0600: give it the original's mode, and owner if we can
+                original = os.stat(target)
+                os.chmod(output.name, stat.S_IMODE(original.st_mode))
+                try:
+                    os.chown(output.name, original.st_uid, original.st_gid)
+                except OSError:
+                    pass
+                os.rename(output.name, target)
+
+    def _readsfrom(self, fileobj):
+        """
+        Whether a file object is the one the archive is read from, or another handle on the same file
+        """
+        if fileobj is self.fp:
+            return True
+        try:
+            return os.path.sameopenfile(fileobj.fileno(), self.fp.fileno())
+        except (AttributeError, EnvironmentError, ValueError):    # in memory, or closed
+            return False
+
+    def _sourcepath(self):
+        """
+        Real path of the file the archive is read from, whatever the mode, or None if it isn't a named file
+        """
+        name = getattr(self.fp, "name", None)
+        if isinstance(name, basestring) and os.path.exists(name):
+            return os.path.realpath(name)
+        return None
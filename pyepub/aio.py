@@ -0,0 +1,194 @@
+"""
+asyncio front end: EPUB operations run on a bounded thread pool, so that zip I/O and XML parsing
+never block the event loop.
+
+    >>> from pyepub.aio import AsyncEPUB, asyncio
+    >>> loop = asyncio.get_event_loop()
+    >>> epub = loop.run_until_complete(AsyncEPUB.open("file.epub"))
+    >>> data = loop.run_until_complete(epub.read("OEBPS/Text/chapter1.xhtml"))
+    >>> loop.run_until_complete(epub.close())
+
+Every method returns an asyncio future, to be awaited (or yielded from, in a coroutine).
+Operations on the same book are queued on the event loop, and handed to the executor one at a time:
+a busy book never holds a worker thread waiting for its turn. Operations on different books run
+concurrently, up to the executor's max_workers. Cancelling a future that hasn't started yet keeps
+its operation from ever running; one that is already running in a worker thread completes.
+
+Requires asyncio, or its trollius backport on Python 2.
+"""
+import collections
+import functools
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from . import EPUB
+
+MAX_WORKERS = 8
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def default_executor():
+    """
+    Process-wide executor shared by AsyncEPUB instances, created on first use
+
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(MAX_WORKERS)
+        return _executor
+
+
+class AsyncEPUB(object):
+    """
+    Wraps an EPUB instance, running its blocking operations in an executor
+    """
+
+    def __init__(self, epub, executor=None, loop=None):
+        """
+        :type epub: EPUB
+        :param epub: the wrapped instance, not to be used directly anymore
+        :type executor: concurrent.futures.Executor
+        :param executor: executor of the blocking operations, default_executor() by default
+        :type loop: asyncio.AbstractEventLoop
+        :param loop: event loop of the returned futures, the current one by default
+        """
+        self.epub = epub
+        self.executor = executor or default_executor()
+        self.loop = loop or asyncio.get_event_loop()
+        # the underlying zip file is not safe for concurrent use: one operation at a time
+        self._queue = collections.deque()   # (future, function, args) waiting for the book
+        self._running = None                # executor future of the operation in progress
+
+    @classmethod
+    def open(cls, filename, mode="r", executor=None, loop=None, **kwargs):
+        """
+        Open an EPUB file without blocking the event loop
+
+        :type filename: str or file like object
+        :param filename: as in EPUB()
+        :type mode: str
+        :param mode: as in EPUB()
+        :param kwargs: other EPUB() keyword arguments
+        :return: future of an AsyncEPUB instance
+        """
+        executor = executor or default_executor()
+        loop = loop or asyncio.get_event_loop()
+
+        def opened():
+            return cls(EPUB(filename, mode, **kwargs), executor, loop)
+        return loop.run_in_executor(executor, opened)
+
+    def _submit(self, function, *args):
+        """
+        Queue an operation on the book; to be called from the event loop's thread
+        """
+        future = asyncio.Future(loop=self.loop)
+        self._queue.append((future, function, args))
+        self._next()
+        return future
+
+    def _next(self):
+        """
+        Hand the next queued operation that wasn't cancelled to the executor, if the book is free
+        """
+        while self._running is None and self._queue:
+            future, function, args = self._queue.popleft()
+            if future.cancelled():
+                continue
+            self._running = self.loop.run_in_executor(self.executor, function, *args)
+            self._running.add_done_callback(functools.partial(self._done, future))
+
+    def _done(self, future, running):
+        self._running = None
+        if not future.cancelled():
+            if running.cancelled():
+                future.cancel()
+            elif running.exception() is not None:
+                future.set_exception(running.exception())
+            else:
+                future.set_result(running.result())
+        self._next()
+
+    def read(self, name):
+        """
+        :return: future of the decompressed member
+        """
+        return self._submit(self.epub.read, name)
+
+    def readrange(self, name, start, end=None):
+        """
+        :return: future of the byte range of a member, see EPUB.readrange()
+        """
+        return self._submit(self.epub.readrange, name, start, end)
+
+    def info(self):
+        """
+        :return: future of EPUB.info
+        """
+        return self._submit(getattr, self.epub, "info")
+
+    def contents(self):
+        """
+        :return: future of EPUB.contents
+        """
+        return self._submit(getattr, self.epub, "contents")
+
+    def text(self):
+        """
+        :return: future of the list of (idref, href, text_chunk) tuples, see EPUB.itertext()
+        """
+        return self._submit(lambda: list(self.epub.itertext()))
+
+    def additem(self, fileObject, href, mediatype):
+        """
+        :return: future of the id of the new item, see EPUB.additem()
+        """
+        return self._submit(self.epub.additem, fileObject, href, mediatype)
+
+    def addpart(self, fileObject, href, mediatype, position=None, reftype="text", linear="yes"):
+        """
+        :return: future of the completed EPUB.addpart()
+        """
+        return self._submit(self.epub.addpart, fileObject, href, mediatype, position, reftype, linear)
+
+    def addmetadata(self, term, value, namespace='dc'):
+        """
+        :return: future of the completed EPUB.addmetadata()
+        """
+        return self._submit(self.epub.addmetadata, term, value, namespace)
+
+    def writetodisk(self, filename):
+        """
+        :return: future of the completed EPUB.writetodisk()
+        """
+        return self._submit(self.epub.writetodisk, filename)
+
+    def save(self):
+        """
+        :return: future of the completed EPUB.save()
+        """
+        return self._submit(self.epub.save)
+
+    def close(self):
+        """
+        :return: future of the completed EPUB.close(); pending operations should be awaited first
+        """
+        return self._submit(self.epub.close)
+
+    def cancel(self):
+        """
+        Cancel the queued operations of this book; the one in progress, if any, completes
+
+        :rtype: int
+        :return: number of operations that won't run
+        """
+        return len([future for future, function, args in self._queue if future.cancel()])
@@ -0,0 +1,322 @@
+"""
+Offline benchmark suite, with a deterministic generator of synthetic EPUB files.
+
+    $ python -m pyepub.bench --output results.json
+    $ python -m pyepub.bench --chapters 2000 --chapter-size 20000 --images 50 --repeat 5
+
+Each case runs in a fresh process. Import time and cold open (import, then metadata of a lazily
+opened book) are timed in fresh interpreters, and the peak memory of each operation is measured in
+an interpreter of its own, which never saw the book being generated.
+Results are written as json, to be compared across versions.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+from multiprocessing import Pool
+from timeit import default_timer
+
+from . import EPUB
+
+DATE_TIME = (2000, 1, 1, 0, 0, 0)  # fixed member timestamps: same parameters, same bytes
+WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do",
+         "eiusmod", "tempor", "incididunt", "ut", "labore", "et", "dolore", "magna", "aliqua")
+
+# Default suite, as (name, generate() parameters)
+CASES = [
+    ("small", dict(chapters=10, chapter_size=4 * 1024)),
+    ("many-chapters", dict(chapters=2000, chapter_size=2 * 1024, ncx_depth=3)),
+    ("large-chapters", dict(chapters=20, chapter_size=1024 * 1024)),
+    ("illustrated", dict(chapters=50, chapter_size=16 * 1024, images=100, image_size=256 * 1024, guide=False)),
+]
+
+# Run by startup() in a fresh interpreter: prints import time and cold open time
+STARTUP = ("import sys\n"
+           "from timeit import default_timer\n"
+           "start = default_timer()\n"
+           "import pyepub\n"
+           "imported = default_timer()\n"
+           "pyepub.EPUB(sys.argv[1], lazy=True).metadata\n"
+           "sys.stdout.write('%r %r' % (imported - start, default_timer() - start))\n")
+
+# Run by memory() in a fresh interpreter: runs one operation, prints the peak RSS in kB
+MEMORY = ("import resource, sys\n"
+          "import pyepub\n"
+          "def peak():\n"
+          "    try:\n"
+          "        with open('/proc/self/status') as status:\n"
+          "            return int([x for x in status if x.startswith('VmHWM:')][0].split()[1])\n"
+          "    except (IOError, IndexError):\n"
+          "        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+          "path, output, operation = sys.argv[1:]\n"
+          "if operation == 'open':\n"
+          "    pyepub.EPUB(path).close()\n"
+          "elif operation == 'info':\n"
+          "    pyepub.EPUB(path, lazy=True).info\n"
+          "elif operation == 'writetodisk':\n"
+          "    epub = pyepub.EPUB(path, 'a')\n"
+          "    epub.addmetadata('subject', 'benchmark')\n"
+          "    epub.writetodisk(output)\n"
+          "sys.stdout.write('%d' % peak())\n")
+MEMORY_OPERATIONS = ("import", "open", "info", "writetodisk")   # import alone is the baseline
+
+
+def _member(epub_zip, name, data, compress_type=zipfile.ZIP_DEFLATED):
+    zinfo = zipfile.ZipInfo(name, DATE_TIME)
+    zinfo.external_attr = 0o644 << 16
+    epub_zip.writestr(zinfo, data, compress_type)
+
+
+def _chapter(rnd, index, size):
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = "<p>%s</p>" % " ".join(rnd.choice(WORDS) for i in range(60))
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Chapter %d</title></head>'
+            '<body><h1>Chapter %d</h1>%s</body></html>') % (index, index, "".join(paragraphs))
+
+
+def _navmap(chapters, depth):
+    """
+    navPoints of the chapters, nested depth levels deep: chapter 0 is at level 1,
+    chapter 1 is its child, and so on down to depth, then back to level 1
+    """
+    parts = []
+    open_points = 0
+    for i in range(chapters):
+        level = i % depth + 1
+        while open_points >= level:
+            parts.append("</navPoint>")
+            open_points -= 1
+        parts.append('<navPoint id="nav%d" playOrder="%d"><navLabel><text>Chapter %d</text></navLabel>'
+                     '<content src="Text/chapter%04d.xhtml"/>' % (i, i + 1, i, i))
+        open_points += 1
+    parts.append("</navPoint>" * open_points)
+    return "".join(parts)
+
+
+def generate(target, chapters=10, chapter_size=4096, images=0, image_size=16384, ncx_depth=1, guide=True, seed=0):
+    """
+    Write a synthetic, valid EPUB2 file. The same parameters always give the same bytes.
+
+    :type target: str or file like object
+    :param target: file to be written
+    :type chapters: int
+    :param chapters: number of XHTML documents in the spine
+    :type chapter_size: int
+    :param chapter_size: approximate size of each document, in bytes
+    :type images: int
+    :param images: number of (incompressible) images in the manifest, the first one is the cover
+    :type image_size: int
+    :param image_size: size of each image, in bytes
+    :type ncx_depth: int
+    :param ncx_depth: nesting depth of the NCX navMap
+    :type guide: bool
+    :param guide: whether the OPF has a <guide> element
+    :type seed: int
+    :param seed: seed of the text and image generator
+    """
+    rnd = random.Random(seed)
+    epub_zip = zipfile.ZipFile(target, "w")
+    _member(epub_zip, "mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+    _member(epub_zip, "META-INF/container.xml",
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles>'
+            '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+            '</rootfiles></container>')
+
+    manifest = ['<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>']
+    manifest.extend('<item id="chapter%04d" href="Text/chapter%04d.xhtml" media-type="application/xhtml+xml"/>'
+                    % (i, i) for i in range(chapters))
+    manifest.extend('<item id="image%04d" href="Images/image%04d.jpg" media-type="image/jpeg"/>'
+                    % (i, i) for i in range(images))
+    spine = "".join('<itemref idref="chapter%04d"/>' % i for i in range(chapters))
+    cover = '<meta name="cover" content="image0000"/>' if images else ''
+    if guide:
+        guide = '<guide><reference type="text" title="Start" href="Text/chapter0000.xhtml"/></guide>'
+    else:
+        guide = ''
+    _member(epub_zip, "OEBPS/content.opf",
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="BookId" version="2.0">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+            '<dc:identifier id="BookId" opf:scheme="UUID">urn:uuid:pyepub-bench-%d</dc:identifier>'
+            '<dc:title>Benchmark %d</dc:title><dc:creator>pyepub</dc:creator><dc:language>en</dc:language>'
+            '<dc:date opf:event="modification">2000-01-01</dc:date>%s</metadata>'
+            '<manifest>%s</manifest><spine toc="ncx">%s</spine>%s</package>'
+            % (seed, seed, cover, "".join(manifest), spine, guide))
+    _member(epub_zip, "OEBPS/toc.ncx",
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            '<head><meta name="dtb:uid" content="urn:uuid:pyepub-bench-%d"/>'
+            '<meta name="dtb:depth" content="%d"/></head>'
+            '<docTitle><text>Benchmark %d</text></docTitle><navMap>%s</navMap></ncx>'
+            % (seed, ncx_depth, seed, _navmap(chapters, max(ncx_depth, 1))))
+    for i in range(chapters):
+        _member(epub_zip, "OEBPS/Text/chapter%04d.xhtml" % i, _chapter(rnd, i, chapter_size))
+    for i in range(images):
+        payload = "".join(chr(rnd.getrandbits(8)) for j in range(image_size))
+        _member(epub_zip, "OEBPS/Images/image%04d.jpg" % i, payload, zipfile.ZIP_STORED)
+    epub_zip.close()
+
+
+def _best(repeat, setup, action=None):
+    """
+    Best wall time of action(setup()) over repeat runs; only action is timed, if given
+    """
+    best = None
+    for i in range(repeat):
+        if action is None:
+            start = default_timer()
+            setup()
+        else:
+            value = setup()
+            start = default_timer()
+            action(value)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def startup(path, repeat=3):
+    """
+    Best import time of pyepub, and best time to import it and read the metadata of a book, in fresh interpreters
+
+    :type path: str
+    :param path: EPUB file to be opened
+    :type repeat: int
+    :param repeat: interpreters started, the best times are kept
+    :rtype: (float, float)
+    """
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", STARTUP, os.path.abspath(path)], cwd=package)
+        times.append([float(x) for x in output.split()])
+    return min(x[0] for x in times), min(x[1] for x in times)
+
+
+def memory(path, output):
+    """
+    Peak RSS of the main operations on a book, each in a fresh interpreter. The peak of getrusage()
+    survives fork() and exec(): it would include the peak of this process, so Linux's VmHWM, the peak
+    of the interpreter's own image, is reported where available.
+
+    :type path: str
+    :param path: EPUB file to be opened
+    :type output: str
+    :param output: file written by the writetodisk operation
+    :rtype: dict
+    :return: {operation: peak RSS in kB}
+    """
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return dict((x, int(subprocess.check_output([sys.executable, "-c", MEMORY, os.path.abspath(path),
+                                                 os.path.abspath(output), x], cwd=package)))
+                for x in MEMORY_OPERATIONS)
+
+
+def run_case(params, repeat=3):
+    """
+    Generate a book and time the main operations on it
+
+    :type params: dict
+    :param params: generate() keyword arguments
+    :type repeat: int
+    :param repeat: runs per operation, the best one is kept
+    :rtype: dict
+    """
+    directory = tempfile.mkdtemp(prefix="pyepub-bench-")
+    try:
+        path = os.path.join(directory, "book.epub")
+        output = os.path.join(directory, "output.epub")
+        start = default_timer()
+        generate(path, **params)
+        results = {"generate": default_timer() - start, "size": os.path.getsize(path)}
+
+        results["import"], results["cold_open"] = startup(path, repeat)
+
+        results["open"] = _best(repeat, lambda: EPUB(path).close())
+        results["open_lazy"] = _best(repeat, lambda: EPUB(path, lazy=True).close())
+        results["title"] = _best(repeat, lambda: EPUB(path, lazy=True), lambda epub: epub.title)
+        results["info"] = _best(repeat, lambda: EPUB(path, lazy=True), lambda epub: epub.info)
+        results["addpart"] = _best(repeat, lambda: EPUB(path, "a"),
+                                   lambda epub: epub.addpart("<html/>", "bench.xhtml", "application/xhtml+xml", 0))
+        results["addmetadata"] = _best(repeat, lambda: EPUB(path, "a"),
+                                       lambda epub: epub.addmetadata("subject", "benchmark"))
+
+        def edited():
+            epub = EPUB(path, "a")
+            epub.addmetadata("subject", "benchmark")
+            return epub
+        results["writetodisk"] = _best(repeat, edited, lambda epub: epub.writetodisk(output))
+        results["max_rss_kb"] = memory(path, output)
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(cases=CASES, repeat=3):
+    """
+    Run benchmark cases, each in a fresh process
+
+    :type cases: [(str, dict)]
+    :param cases: (name, generate() keyword arguments) pairs
+    :type repeat: int
+    :param repeat: runs per operation, the best one is kept
+    :rtype: dict
+    :return: json-able results
+    """
+    report = {"python": platform.python_version(),
+              "implementation": platform.python_implementation(),
+              "platform": platform.platform(),
+              "repeat": repeat,
+              "cases": []}
+    for name, params in cases:
+        pool = Pool(1)
+        try:
+            results = pool.apply(run_case, (params, repeat))
+        finally:
+            pool.terminate()
+            pool.join()
+        report["cases"].append({"name": name, "params": params, "results": results})
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time pyepub on synthetic EPUB files and report json results")
+    parser.add_argument("--chapters", type=int, help="run a single case with this many chapters")
+    parser.add_argument("--chapter-size", type=int, default=4096)
+    parser.add_argument("--images", type=int, default=0)
+    parser.add_argument("--image-size", type=int, default=16384)
+    parser.add_argument("--ncx-depth", type=int, default=1)
+    parser.add_argument("--no-guide", dest="guide", action="store_false")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="json file to be written (default: stdout)")
+    args = parser.parse_args(argv)
+
+    cases = CASES
+    if args.chapters is not None:
+        cases = [("custom", dict(chapters=args.chapters, chapter_size=args.chapter_size, images=args.images,
+                                 image_size=args.image_size, ncx_depth=args.ncx_depth, guide=args.guide,
+                                 seed=args.seed))]
+    report = json.dumps(run(cases, args.repeat), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        sys.stdout.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Caches for EPUB files.
+
+MetadataCache is a persistent cache of parsed EPUB metadata, backed by SQLite:
+
+    >>> from pyepub import EPUB
+    >>> from pyepub.cache import MetadataCache
+    >>> cache = MetadataCache("metadata.sqlite")
+    >>> epub = EPUB("file.epub", cache=cache)  # parsed once, then straight from the cache
+
+MemberCache is an in-memory LRU cache of decompressed members and parsed XML trees, with a byte budget;
+use one per EPUB, or share one across the process (e.g. shared_cache):
+
+    >>> from pyepub.cache import shared_cache
+    >>> epub = EPUB("file.epub", member_cache=shared_cache)
+    >>> epub.read("OEBPS/Text/chapter1.xhtml")  # decompressed once, then straight from memory
+
+Files are identified by the CRCs found in the central directory, so that nothing has to be decompressed
+to compute the key; files opened by name also by path, inode, size and mtime.
+"""
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+import zlib
+
+FIELDS = ("info", "id", "cover", "opf_path", "root_folder", "ncx_path", "contents")
+TREE_OVERHEAD = 8   # a parsed tree is accounted as this many times the size of its XML
+
+
+def identity(epub):
+    """
+    Identity of the file behind an EPUB instance
+
+    :type epub: pyepub.EPUB
+    :param epub: an EPUB instance in "r" or "a" mode
+    :rtype: str
+    """
+    crc = 0
+    for zinfo in epub.infolist():
+        crc = zlib.crc32("%s:%08x:%d" % (zinfo.filename, zinfo.CRC, zinfo.file_size), crc)
+    members = "%08x:%d" % (crc & 0xffffffff, len(epub.infolist()))
+    if isinstance(epub.filename, basestring):
+        stat = os.stat(epub.filename)
+        # mtime may be as coarse as a second: the central directory tells same-size rewrites apart
+        return "path:%s:%d:%d:%r:%s" % (os.path.abspath(epub.filename), stat.st_ino, stat.st_size, stat.st_mtime,
+                                        members)
+    return "crc:" + members
+
+
+class MetadataCache(object):
+    """
+    SQLite backed cache of EPUB.info, id, cover, opf_path, ncx_path and contents
+    """
+
+    def __init__(self, path=":memory:", max_entries=100000, max_bytes=None):
+        """
+        :type path: str
+        :param path: SQLite database file
+        :type max_entries: int
+        :param max_entries: number of books kept in the cache
+        :type max_bytes: int
+        :param max_bytes: total size of the serialized entries kept in the cache, None for no limit
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._touched = {}  # access times not yet written to the database: key -> time
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries "
+                         "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, atime REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+        self._db.commit()
+
+    @staticmethod
+    def key(epub):
+        """
+        Cache key of an EPUB instance, see identity()
+        """
+        return identity(epub)
+
+    def load(self, key, epub):
+        """
+        Fill the EPUB instance with the cached entry, if any
+
+        :type key: str
+        :param key: as returned by MetadataCache.key()
+        :type epub: pyepub.EPUB
+        :param epub: instance to be filled
+        :rtype: bool
+        :return: True on a cache hit
+        """
+        row = self._db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        self._touched[key] = time.time()
+        epub.__dict__.update(json.loads(row[0]))
+        epub.metadata = epub.info["metadata"]
+        return True
+
+    def store(self, key, epub):
+        """
+        Parse whatever is still missing from the EPUB instance and cache it
+
+        :type key: str
+        :param key: as returned by MetadataCache.key()
+        :type epub: pyepub.EPUB
+        :param epub: a fully readable EPUB instance
+        """
+        value = json.dumps(dict((field, getattr(epub, field)) for field in FIELDS),
+                           default=dict)   # lxml attributes aren't plain dicts
+        self._touched.pop(key, None)
+        self._db.execute("INSERT OR REPLACE INTO entries (key, value, size, atime) VALUES (?, ?, ?, ?)",
+                         (key, value, len(value), time.time()))
+        self._flush()
+        self._evict()
+        self._db.commit()
+
+    def _flush(self):
+        """
+        Write pending access times: they are kept in memory so that a hit never writes to disk
+        """
+        if self._touched:
+            self._db.executemany("UPDATE entries SET atime = ? WHERE key = ?",
+                                 [(atime, key) for key, atime in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self):
+        """
+        Drop the least recently used entries past max_entries and max_bytes
+        """
+        self._db.execute("DELETE FROM entries WHERE key IN "
+                         "(SELECT key FROM entries ORDER BY atime DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        if self.max_bytes is None:
+            return
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        for key, size in self._db.execute("SELECT key, size FROM entries ORDER BY atime").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        self._flush()
+        self._db.commit()
+        self._db.close()
+
+
+class MemberCache(object):
+    """
+    Thread safe LRU cache of decompressed members and parsed XML trees, within a byte budget.
+    Entries of an EPUB are invalidated when the EPUB writes or deletes the member.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        :type max_bytes: int
+        :param max_bytes: total size of the cached entries; parsed trees count TREE_OVERHEAD times their XML
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = collections.OrderedDict()   # (identity, name, kind) -> (value, size), oldest first
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _identity(epub):
+        key = epub.__dict__.get("_identity")
+        if key is None:
+            key = epub.__dict__["_identity"] = identity(epub)
+        return key
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # most recently used
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted = self._entries.popitem(last=False)[1]
+                self.size -= evicted[1]
+                self.evictions += 1
+
+    def read(self, epub, name, pwd=None):
+        """
+        Decompressed member, see zipfile.ZipFile.read()
+
+        :type epub: pyepub.EPUB
+        :param epub: archive the member belongs to
+        :type name: str or zipfile.ZipInfo
+        :param name: member of the archive
+        :rtype: str
+        """
+        if isinstance(name, zipfile.ZipInfo):
+            name = name.filename
+        key = (self._identity(epub), name, "bytes")
+        data = self._get(key)
+        if data is None:
+            data = zipfile.ZipFile.read(epub, name, pwd)
+            self._put(key, data, len(data))
+        return data
+
+    def tree(self, epub, name, parse):
+        """
+        Parsed XML member. The tree is shared: don't modify it.
+
+        :type epub: pyepub.EPUB
+        :param epub: archive the member belongs to
+        :type name: str
+        :param name: member of the archive
+        :type parse: callable
+        :param parse: XML parser, e.g. ET.fromstring
+        """
+        key = (self._identity(epub), name, "tree")
+        tree = self._get(key)
+        if tree is None:
+            data = self.read(epub, name)
+            tree = parse(data)
+            self._put(key, tree, TREE_OVERHEAD * len(data))
+        return tree
+
+    def invalidate(self, epub, name=None):
+        """
+        Drop the cached entries of an archive member, or of the whole archive
+
+        :type epub: pyepub.EPUB
+        :param epub: archive the member belongs to
+        :type name: str
+        :param name: member of the archive, None for all of them
+        """
+        identity = self._identity(epub)
+        with self._lock:
+            if name is None:
+                keys = [x for x in self._entries if x[0] == identity]
+            else:
+                keys = [(identity, name, "bytes"), (identity, name, "tree")]
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[1]
+
+    def stats(self):
+        """
+        Hit/miss statistics
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self.size, "max_bytes": self.max_bytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+shared_cache = MemberCache()    # process-wide cache, to be passed as EPUB(..., member_cache=shared_cache)
@@ -0,0 +1,313 @@
+"""
+Cross-book deduplication of EPUB members (fonts, stylesheets, logos...).
+
+    $ python -m pyepub.dedup report DIRECTORY [DIRECTORY ...] > duplicates.json
+    $ python -m pyepub.dedup export --store STORE DIRECTORY [DIRECTORY ...]
+    $ python -m pyepub.dedup rebuild --store STORE KEY OUTPUT
+
+Duplicates are found in two passes: members are first grouped by the CRC and size recorded in the
+central directory, which costs no decompression at all; only members sharing both are then hashed.
+
+A ContentStore keeps every distinct member once, as the compressed bytes found in the first book
+that had it, under objects/ab/abcdef...; books/KEY.json lists the members of each exported book,
+in archive order. Rebuilding a book copies those bytes back as they are: nothing is recompressed.
+The command line keys books by their path relative to the scanned directory, without extension
+(e.g. authors/melville/moby-dick).
+"""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import zipfile
+
+from . import EPUB, COPY_CHUNK_SIZE
+from .scan import find_epubs
+
+HASH = "sha256"
+
+
+def digest(epub, name):
+    """
+    Strong hash of a decompressed member
+
+    :type epub: zipfile.ZipFile
+    :param epub: archive the member belongs to, an EPUB or a plain zip file
+    :type name: str
+    :param name: member of the archive
+    :rtype: str
+    """
+    hashed = hashlib.new(HASH)
+    stream = epub.open(name)
+    try:
+        chunk = stream.read(COPY_CHUNK_SIZE)
+        while chunk:
+            hashed.update(chunk)
+            chunk = stream.read(COPY_CHUNK_SIZE)
+    finally:
+        stream.close()
+    return hashed.hexdigest()
+
+
+def _failed(errors, path, e):
+    """
+    Record a book that couldn't be read, as scan.describe() does; re-raise if there is no errors list
+    """
+    if errors is None:
+        raise
+    errors.append({"path": path, "error": e.__class__.__name__, "message": str(e)})
+
+
+def duplicates(paths, min_size=1, errors=None):
+    """
+    Members found more than once across books (or within one). Books are read as plain zip files,
+    whether or not they are valid EPUB files.
+
+    :type paths: iterable of str
+    :param paths: paths of the EPUB files, e.g. scan.find_epubs(directory)
+    :type min_size: int
+    :param min_size: smaller members are ignored
+    :type errors: list
+    :param errors: if given, a book that can't be read is appended to it as {"path": ..., "error": ..., "message": ...}
+                   and left out of the report; else the exception is raised
+    :rtype: list
+    :return: [{"digest": ..., "size": ..., "members": [{"path": ..., "name": ...}]}],
+             most wasted bytes first
+    """
+    # First pass: central directories only
+    groups = collections.defaultdict(list)     # (CRC, size) -> [(path, name)]
+    for path in paths:
+        try:
+            archive = zipfile.ZipFile(path)
+        except Exception as e:
+            _failed(errors, path, e)
+            continue
+        try:
+            for zinfo in archive.infolist():
+                if zinfo.file_size >= min_size and not zinfo.filename.endswith("/"):
+                    groups[(zinfo.CRC, zinfo.file_size)].append((path, zinfo.filename))
+        finally:
+            archive.close()
+
+    # Second pass: hash the candidates, opening each book once
+    candidates = collections.defaultdict(list)  # path -> [name]
+    for members in groups.itervalues():
+        if len(members) > 1:
+            for path, name in members:
+                candidates[path].append(name)
+    found = collections.defaultdict(list)       # digest -> [(path, name)]
+    sizes = {}
+    for path, names in sorted(candidates.iteritems()):
+        hashed = []
+        try:
+            archive = zipfile.ZipFile(path)
+            try:
+                for name in names:
+                    hashed.append((digest(archive, name), name, archive.getinfo(name).file_size))
+            finally:
+                archive.close()
+        except Exception as e:     # e.g. a corrupt member: the whole book is left out
+            _failed(errors, path, e)
+            continue
+        for key, name, size in hashed:
+            found[key].append({"path": path, "name": name})
+            sizes[key] = size
+
+    report = [{"digest": key, "size": sizes[key], "members": members}
+              for key, members in found.iteritems() if len(members) > 1]
+    report.sort(key=lambda x: (-x["size"] * (len(x["members"]) - 1), x["digest"]))
+    return report
+
+
+class ContentStore(object):
+    """
+    Directory of members addressed by content, and of the books made out of them
+    """
+
+    def __init__(self, root):
+        """
+        :type root: str
+        :param root: directory of the store, created if needed
+        """
+        self.root = root
+        for folder in ("objects", "books"):
+            if not os.path.isdir(os.path.join(root, folder)):
+                os.makedirs(os.path.join(root, folder))
+
+    def _object(self, key, compress_type):
+        return os.path.join(self.root, "objects", key[:2], "%s.%d" % (key, compress_type))
+
+    def _find(self, key):
+        """
+        (path, compress_type) of the stored object of a digest, or None
+        """
+        for compress_type in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            path = self._object(key, compress_type)
+            if os.path.exists(path):
+                return path, compress_type
+        return None
+
+    def _book(self, key):
+        return os.path.join(self.root, "books", *key.split("/")) + ".json"
+
+    def books(self):
+        """
+        Keys of the exported books
+
+        :rtype: list
+        """
+        folder = os.path.join(self.root, "books")
+        keys = []
+        for root, dirs, files in os.walk(folder):
+            prefix = os.path.relpath(root, folder).replace(os.sep, "/")
+            keys.extend(x[:-5] if prefix == "." else "%s/%s" % (prefix, x[:-5]) for x in files if x.endswith(".json"))
+        return sorted(keys)
+
+    def export(self, path, key=None):
+        """
+        Add the members of a book to the store, and record the book's manifest
+
+        :type path: str
+        :param path: path of the EPUB file
+        :type key: str
+        :param key: name of the book in the store, the file name without extension by default;
+                    may contain "/" separated folders
+        :rtype: dict
+        :return: {"added": number of new objects, "bytes": their size, "members": number of members}
+        :raises ValueError: if the key already belongs to a book exported from another path
+        """
+        if key is None:
+            key = os.path.splitext(os.path.basename(path))[0]
+        if os.path.exists(self._book(key)):
+            with open(self._book(key)) as manifest:
+                source = json.load(manifest)["source"]
+            if os.path.realpath(source) != os.path.realpath(path):
+                raise ValueError("Key %r already belongs to %s" % (key, source))
+        epub = EPUB(path, lazy=True)
+        members = []
+        added = added_bytes = 0
+        try:
+            for zinfo in epub.infolist():
+                member_key = digest(epub, zinfo.filename)
+                stored = self._find(member_key)
+                if stored is None:
+                    target = self._object(member_key, zinfo.compress_type)
+                    self._copyout(epub, zinfo, target)
+                    stored = target, zinfo.compress_type
+                    added += 1
+                    added_bytes += zinfo.compress_size
+                members.append({"name": zinfo.filename,
+                                "digest": member_key,
+                                "compress_type": stored[1],
+                                "CRC": zinfo.CRC,
+                                "file_size": zinfo.file_size,
+                                "date_time": zinfo.date_time,
+                                "external_attr": zinfo.external_attr,
+                                "flag_bits": zinfo.flag_bits & 0x800})  # keep the utf-8 name flag only
+        finally:
+            epub.close()
+        record = {"source": os.path.abspath(path), "members": members}
+        self._atomic_write(self._book(key), json.dumps(record, indent=1))
+        return {"added": added, "bytes": added_bytes, "members": len(members)}
+
+    @staticmethod
+    def _copyout(epub, zinfo, target):
+        """
+        Write the compressed bytes of a member to target, as they are in the archive
+        """
+        epub.fp.seek(zinfo.header_offset)
+        epub.fp.seek(EPUB._data_offset(zinfo, epub.fp.read(zipfile.sizeFileHeader)))
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(target))
+        try:
+            with os.fdopen(fd, "wb") as output:
+                remaining = zinfo.compress_size
+                while remaining > 0:
+                    chunk = epub.fp.read(min(COPY_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise zipfile.BadZipfile("Truncated data for %s" % zinfo.filename)
+                    output.write(chunk)
+                    remaining -= len(chunk)
+            os.rename(temp, target)
+        except:
+            os.remove(temp)
+            raise
+
+    @staticmethod
+    def _atomic_write(target, data):
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(target))
+        with os.fdopen(fd, "wb") as output:
+            output.write(data)
+        os.rename(temp, target)
+
+    def rebuild(self, key, target):
+        """
+        Write a standalone EPUB file from the store
+
+        :type key: str
+        :param key: name of the book in the store
+        :type target: str or file like object
+        :param target: file to be written
+        """
+        with open(self._book(key)) as manifest:
+            members = json.load(manifest)["members"]
+        epub_zip = zipfile.ZipFile(target, "w", allowZip64=True)
+        try:
+            for member in members:
+                zinfo = zipfile.ZipInfo(member["name"], tuple(member["date_time"]))
+                zinfo.compress_type = member["compress_type"]
+                zinfo.external_attr = member["external_attr"]
+                zinfo.flag_bits = member["flag_bits"]
+                zinfo.CRC = member["CRC"]
+                zinfo.file_size = member["file_size"]
+                path = self._object(member["digest"], member["compress_type"])
+                zinfo.compress_size = os.path.getsize(path)
+                with open(path, "rb") as source:
+                    EPUB._write_member(epub_zip, zinfo, source)
+        finally:
+            epub_zip.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find, store and rebuild EPUB members shared across books")
+    commands = parser.add_subparsers(dest="command")
+    report = commands.add_parser("report", help="json report of the duplicated members")
+    report.add_argument("directories", nargs="+", metavar="DIRECTORY")
+    report.add_argument("--min-size", type=int, default=1, help="ignore smaller members")
+    export = commands.add_parser("export", help="add books to a content-addressed store")
+    export.add_argument("--store", required=True)
+    export.add_argument("directories", nargs="+", metavar="DIRECTORY")
+    rebuild = commands.add_parser("rebuild", help="write a standalone EPUB out of the store")
+    rebuild.add_argument("--store", required=True)
+    rebuild.add_argument("key")
+    rebuild.add_argument("output")
+    args = parser.parse_args(argv)
+
+    if args.command == "report":
+        errors = []
+        json.dump(duplicates(find_epubs(*args.directories), args.min_size, errors), sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        for error in errors:
+            sys.stderr.write(json.dumps(error) + "\n")
+    elif args.command == "export":
+        store = ContentStore(args.store)
+        for directory in args.directories:
+            for path in find_epubs(directory):
+                key = os.path.splitext(os.path.relpath(path, directory))[0].replace(os.sep, "/")
+                try:
+                    result = store.export(path, key)
+                except ValueError as e:     # same relative path under two of the directories
+                    result = {"error": e.__class__.__name__, "message": str(e)}
+                result["path"] = path
+                sys.stdout.write(json.dumps(result) + "\n")
+    else:
+        ContentStore(args.store).rebuild(args.key, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Differences between two versions of an EPUB, as a patch that turns the old archive into the new one.
+
+    >>> from pyepub import EPUB
+    >>> from pyepub import diff
+    >>> patch = diff.diff(EPUB("old.epub"), EPUB("new.epub"))
+    >>> patch["changes"]["metadata"]
+    {'date': ['2013-01-01', '2014-03-12']}
+    >>> diff.write_patch(patch, "new.patch")
+    >>> epub = EPUB("old.epub", "a")
+    >>> diff.apply(epub, diff.read_patch("new.patch"))
+    >>> epub.writetodisk("new.epub")
+
+Members are compared by the CRC and size recorded in the central directories: unchanged members
+are never decompressed, and the patch only carries the bytes of added and changed ones.
+container.xml, the OPF and the NCX are rebuilt from their parsed trees, like any other edit: they come
+out equivalent to the new version's, not necessarily byte for byte identical.
+"""
+import json
+import os
+import zipfile
+
+from . import ET, InvalidEpub
+
+PATCH_VERSION = 1
+
+
+def _members(epub):
+    return dict((x.filename, (x.CRC, x.file_size)) for x in epub.infolist() if not x.filename.endswith("/"))
+
+
+def _dictdiff(old, new):
+    """
+    {key: [old value, new value]} of the keys whose value differs, None standing for a missing key
+    """
+    return dict((key, [old.get(key), new.get(key)]) for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+
+def _listdiff(old, new):
+    """
+    None if equal, else {"old": [...], "new": [...]}
+    """
+    if old == new:
+        return None
+    return {"old": old, "new": new}
+
+
+def diff(old, new):
+    """
+    Compare two EPUB instances
+
+    :type old: pyepub.EPUB
+    :param old: the previous version
+    :type new: pyepub.EPUB
+    :param new: the revised version
+    :rtype: dict
+    :return: patch, json-able except for "data": {member: bytes} of the added and changed members
+    """
+    old_members, new_members = _members(old), _members(new)
+    added = sorted(x for x in new_members if x not in old_members)
+    removed = sorted(x for x in old_members if x not in new_members)
+    changed = sorted(x for x in new_members if x in old_members and new_members[x] != old_members[x])
+
+    old_manifest = dict((x["id"], x) for x in old.info["manifest"])
+    new_manifest = dict((x["id"], x) for x in new.info["manifest"])
+    changes = {"metadata": _dictdiff(old.info["metadata"], new.info["metadata"]),
+               "manifest": {"added": sorted(x for x in new_manifest if x not in old_manifest),
+                            "removed": sorted(x for x in old_manifest if x not in new_manifest),
+                            "changed": sorted(x for x in new_manifest
+                                              if x in old_manifest and new_manifest[x] != old_manifest[x])},
+               "spine": _listdiff([x["idref"] for x in old.info["spine"]], [x["idref"] for x in new.info["spine"]]),
+               "guide": _listdiff(old.info["guide"], new.info["guide"]),
+               "contents": _listdiff([(x["name"], x["src"]) for x in old.contents],
+                                     [(x["name"], x["src"]) for x in new.contents])}
+
+    return {"version": PATCH_VERSION,
+            "base": dict((x, old_members[x]) for x in removed + changed),
+            "opf_path": new.opf_path,
+            "ncx_path": new.ncx_path,
+            "added": added,
+            "removed": removed,
+            "changed": changed,
+            "unchanged": len(new_members) - len(added) - len(changed),
+            "changes": changes,
+            "data": dict((x, new.read(x)) for x in added + changed)}
+
+
+def apply(epub, patch):
+    """
+    Apply a patch to the archive it was computed against; the result is written by
+    epub.writetodisk() or epub.save(), as any other edit
+
+    :type epub: pyepub.EPUB
+    :param epub: the previous version, in "a" mode
+    :type patch: dict
+    :param patch: as returned by diff() or read_patch()
+    """
+    assert epub.epub_mode == "a", "Patches are applied in append mode"
+    if patch["version"] != PATCH_VERSION:
+        raise InvalidEpub("Unsupported patch version %s" % patch["version"])
+    members = _members(epub)
+    for name, (crc, size) in patch["base"].iteritems():
+        if members.get(name) != (crc, size):
+            raise InvalidEpub("The patch doesn't apply to %s: %s differs" % (epub.filename, name))
+
+    # container.xml, OPF and NCX are rebuilt from the trees on write: replace the trees
+    package = set(["META-INF/container.xml", epub.opf_path, epub.ncx_path, patch["opf_path"], patch["ncx_path"]])
+    data = patch["data"]
+    if patch["opf_path"] in data:
+        epub.opf_path = patch["opf_path"]
+        epub.root_folder = os.path.dirname(epub.opf_path)
+        epub.opf = ET.fromstring(data[epub.opf_path])
+        for name in ("manifest", "metadata", "id", "cover", "info", "contents"):
+            epub.__dict__.pop(name, None)
+        epub.ncx_path = patch["ncx_path"]
+    if patch["ncx_path"] in data:
+        epub.ncx = ET.fromstring(data[patch["ncx_path"]])
+        epub.__dict__.pop("contents", None)
+
+    for name in patch["added"] + patch["changed"]:
+        if name not in package and name != "mimetype":
+            epub._writestr(name, data[name])
+    epub._delete(*patch["removed"])
+
+
+def write_patch(patch, target):
+    """
+    Save a patch as a zip file: patch.json, plus the data of every added or changed member under data/
+
+    :type patch: dict
+    :param patch: as returned by diff()
+    :type target: str or file like object
+    :param target: file to be written
+    """
+    patch_zip = zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+        patch_zip.writestr("patch.json", json.dumps(dict((x, y) for x, y in patch.iteritems() if x != "data")))
+        for name, data in patch["data"].iteritems():
+            patch_zip.writestr("data/" + name, data)
+    finally:
+        patch_zip.close()
+
+
+def read_patch(source):
+    """
+    Load a patch saved by write_patch()
+
+    :type source: str or file like object
+    :param source: file to be read
+    :rtype: dict
+    """
+    patch_zip = zipfile.ZipFile(source)
+    try:
+        patch = json.loads(patch_zip.read("patch.json"))
+        patch["data"] = dict((x[len("data/"):], patch_zip.read(x)) for x in patch_zip.namelist()
+                             if x.startswith("data/"))
+    finally:
+        patch_zip.close()
+    return patch
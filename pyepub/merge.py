@@ -0,0 +1,238 @@
+"""
+Merge EPUB files into an omnibus edition, or split one into volumes.
+
+    >>> from pyepub.merge import merge, split
+    >>> merge(["book1.epub", "book2.epub", "book3.epub"], "omnibus.epub", title="The Complete Trilogy")
+    >>> split("omnibus.epub", ["volume1.epub", "volume2.epub"], [0, 12])
+
+Members are copied as they are, compressed bytes included, straight from archive to archive:
+they are never decompressed, nor held in memory. Only the OPF and NCX of one source at a time
+are parsed. Spine, guide and NCX navMap are concatenated (or partitioned), and playOrder is renumbered.
+A merged book takes the title, creator, language and cover of the first book; a volume of a split
+takes every metadata entry of the source, but its identifier and title.
+"""
+import copy
+import posixpath
+import urllib
+
+from . import EPUB, ET, NAMESPACE
+
+PREFIX = "book"     # merged books go in OEBPS/book1/, OEBPS/book2/... and their ids are prefixed with book1-...
+
+
+def _href(path, folder):
+    """
+    href of an archive path, relative to folder
+    """
+    return urllib.quote(posixpath.relpath(path, folder) if folder else path)
+
+
+def _rewrite(href, base, paths, folder):
+    """
+    Rewrite an href (fragment included) relative to base into an href relative to folder,
+    given the archive paths of the copied members; None if its member wasn't copied
+    """
+    path = EPUB._resolve(href, base)
+    if path not in paths:
+        return None
+    fragment = href.partition("#")[2]
+    return _href(paths[path], folder) + ("#" + fragment if fragment else "")
+
+
+def _append(epub, output, items, itemrefs, prefix):
+    """
+    Copy manifest items of epub into output, along with the given spine itemrefs, and the guide references
+    and navPoints that point at the copied members
+
+    :type epub: EPUB
+    :param epub: source, in "r" mode
+    :type output: EPUB
+    :param output: target, in "w" mode
+    :type items: [ManifestItem]
+    :param items: manifest items to be copied
+    :type itemrefs: [SpineItem]
+    :param itemrefs: spine items to be appended to the spine of output
+    :type prefix: str
+    :param prefix: folder of the copies inside output's root folder, and prefix of their ids; may be empty
+    :rtype: dict
+    :return: source id -> new id, of the copied items
+    """
+    manifest = output.manifest
+    names = set(epub.namelist())
+    ids = {}        # source id -> new id
+    paths = {}      # source archive path -> new archive path
+    for item in items:
+        path = EPUB._resolve(item.href, epub.root_folder)
+        if path not in names:
+            continue
+        ids[item.id] = "%s-%s" % (prefix, item.id) if prefix else item.id
+        paths[path] = posixpath.join(output.root_folder, prefix, posixpath.relpath(path, epub.root_folder))
+        element = ET.Element(item.element.tag, attrib=dict(item.element.attrib))
+        element.set("id", ids[item.id])
+        element.set("href", _href(paths[path], output.root_folder))
+        manifest.add(element)
+    for zinfo in epub.infolist():
+        if zinfo.filename in paths:
+            epub._copy_member(output, zinfo, paths[zinfo.filename])
+
+    for itemref in itemrefs:
+        if itemref.idref in ids:
+            element = ET.Element(itemref.element.tag, attrib=dict(itemref.element.attrib))
+            element.set("idref", ids[itemref.idref])
+            manifest.insert_itemref(None, element)
+
+    if manifest.guide is not None and epub.manifest.guide:
+        for reference in epub.manifest.guide:
+            href = _rewrite(reference.href, epub.root_folder, paths, output.root_folder)
+            if href is not None:
+                element = ET.Element(reference.element.tag, attrib=dict(reference.element.attrib))
+                element.set("href", href)
+                manifest.insert_reference(None, element)
+
+    if epub.manifest.toc is None or epub.ncx_path not in names:
+        return ids
+    navmap = epub.ncx.find("{0}navMap".format(NAMESPACE["ncx"]))
+    if navmap is None:
+        return ids
+    ncx_folder = posixpath.dirname(epub.ncx_path)
+    output_folder = posixpath.dirname(output.ncx_path)
+    tag = "{0}navPoint".format(NAMESPACE["ncx"])
+
+    def points(parent):
+        """
+        navPoints of parent that point at copied members, rewritten; the children of the others are lifted
+        """
+        kept = []
+        for point in parent:
+            if point.tag != tag:
+                continue
+            children = points(point)
+            content = point.find("{0}content".format(NAMESPACE["ncx"]))
+            src = None if content is None else _rewrite(content.get("src", ""), ncx_folder, paths, output_folder)
+            if src is None:
+                kept.extend(children)
+                continue
+            content.set("src", src)
+            if prefix and point.get("id"):
+                point.set("id", "%s-%s" % (prefix, point.get("id")))
+            point[:] = [x for x in point if x.tag != tag] + children
+            kept.append(point)
+        return kept
+
+    output.ncx.find("{0}navMap".format(NAMESPACE["ncx"])).extend(points(copy.deepcopy(navmap)))
+    return ids
+
+
+def _finish(output, source, title, ids, everything=False):
+    """
+    Fill the metadata of output from the source's, carry the cover over, renumber playOrder
+
+    :type output: EPUB
+    :param output: target, in "w" mode
+    :type source: Element
+    :param source: <metadata> element of the source OPF
+    :type title: str
+    :param title: title of output, the source's if None
+    :type ids: dict
+    :param ids: source id -> new id, of the items copied from the source
+    :type everything: bool
+    :param everything: copy every entry of the source but its identifiers, not only title, creator and language
+    """
+    metadata = output.opf.find("{0}metadata".format(NAMESPACE["opf"]))
+    cover = source.find('{0}meta[@name="cover"]'.format(NAMESPACE["opf"]))
+    if everything:
+        identifier = NAMESPACE["dc"] + "identifier"
+        metadata[:] = ([x for x in metadata if x.tag == identifier] +     # output's own unique identifier
+                       [copy.deepcopy(x) for x in source if x.tag != identifier and x is not cover])
+    else:
+        for term in ("title", "creator", "language"):
+            element, value = metadata.find(NAMESPACE["dc"] + term), source.find(NAMESPACE["dc"] + term)
+            if element is not None and value is not None:
+                element.text = value.text
+    element = metadata.find(NAMESPACE["dc"] + "title")
+    if title is not None and element is not None:
+        element.text = title
+    if cover is not None and cover.get("content") in ids:
+        metadata.append(ET.Element("{0}meta".format(NAMESPACE["opf"]),
+                                   attrib={"name": "cover", "content": ids[cover.get("content")]}))
+    text = output.ncx.find("{0}docTitle/{0}text".format(NAMESPACE["ncx"]))
+    if text is not None and element is not None:
+        text.text = element.text
+    for i, point in enumerate(output.ncx.iter("{0}navPoint".format(NAMESPACE["ncx"]))):
+        point.set("playOrder", str(i + 1))
+    for name in ("metadata", "cover", "info", "contents"):
+        output.__dict__.pop(name, None)     # rebuilt on next access
+
+
+def merge(sources, target, title=None):
+    """
+    Concatenate EPUB files into a new one. Each book goes in a folder of its own,
+    its manifest ids prefixed, so that nothing collides.
+
+    :type sources: iterable of str or file like objects
+    :param sources: books to be merged, in order
+    :type target: str or file like object
+    :param target: file to be written
+    :type title: str
+    :param title: title of the merged book, the first book's by default
+    """
+    output = EPUB(target, "w")
+    try:
+        first = None
+        for index, source in enumerate(sources):
+            epub = EPUB(source, lazy=True)
+            try:
+                manifest = epub.manifest
+                items = [x for x in manifest.items if x is not manifest.toc]
+                ids = _append(epub, output, items, manifest.spine, "%s%d" % (PREFIX, index + 1))
+                if index == 0:
+                    first = epub.opf.find("{0}metadata".format(NAMESPACE["opf"])), ids
+            finally:
+                epub.close()
+        if first is not None:
+            _finish(output, first[0], title, first[1])
+    finally:
+        output.close()
+
+
+def split(source, targets, starts, titles=None):
+    """
+    Partition the spine of an EPUB file into volumes. Every volume gets its own spine documents,
+    and a copy of every resource that isn't in the spine (stylesheets, images, fonts...).
+
+    :type source: str or file like object
+    :param source: book to be split
+    :type targets: [str or file like object]
+    :param targets: files to be written, one per volume
+    :type starts: [int]
+    :param starts: position in the spine where each volume starts, the first one being 0
+    :type titles: [str]
+    :param titles: titles of the volumes, "<title> (1/n)"... by default
+    """
+    assert len(targets) == len(starts), "One start per volume"
+    epub = EPUB(source, lazy=True)
+    try:
+        manifest = epub.manifest
+        spine = [x for x in manifest.spine if x.idref in manifest.by_id]
+        documents = set(x.idref for x in spine)
+        metadata = epub.opf.find("{0}metadata".format(NAMESPACE["opf"]))
+        title = epub.metadata.get("title")
+        if isinstance(title, list):
+            title = title[0]
+        ends = list(starts[1:]) + [len(spine)]
+        for index, (target, start, end) in enumerate(zip(targets, starts, ends)):
+            volume = set(x.idref for x in spine[start:end])
+            items = [x for x in manifest.items
+                     if x is not manifest.toc and (x.id not in documents or x.id in volume)]
+            output = EPUB(target, "w")
+            try:
+                ids = _append(epub, output, items, spine[start:end], "")
+                if titles is not None:
+                    volume_title = titles[index]
+                else:
+                    volume_title = "%s (%d/%d)" % (title or "", index + 1, len(targets))
+                _finish(output, metadata, volume_title, ids, everything=True)
+            finally:
+                output.close()
+    finally:
+        epub.close()
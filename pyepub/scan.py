@@ -0,0 +1,91 @@
+"""
+Bulk catalog scanner: walks directories of EPUB files and emits one json line per book.
+
+    $ python -m pyepub.scan [-j PROCESSES] DIRECTORY [DIRECTORY ...] > catalog.jsonl
+
+Books are spread across a process pool. A file that can't be processed doesn't stop the run:
+it comes out as an error record, {"path": ..., "error": ..., "message": ...}.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+from . import EPUB
+
+
+def find_epubs(*directories):
+    """
+    Walk directories, yielding the path of every .epub file found
+
+    :type directories: [str]
+    :param directories: roots of the directory trees to be walked
+    """
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".epub"):
+                    yield os.path.join(root, name)
+
+
+def describe(path):
+    """
+    Build the json record of a single book
+
+    :type path: str
+    :param path: path of the EPUB file
+    :rtype: str
+    :return: a json line, without the trailing newline
+    """
+    try:
+        epub = EPUB(path)
+        try:
+            record = {"path": path,
+                      "id": epub.id,
+                      "cover": epub.cover,
+                      "info": epub.info,
+                      "contents": epub.contents}
+        finally:
+            epub.close()
+        return json.dumps(record, default=dict)    # lxml attributes aren't plain dicts
+    except Exception as e:
+        return json.dumps({"path": path,
+                           "error": e.__class__.__name__,
+                           "message": str(e)})
+
+
+def scan(paths, processes=None, chunksize=4):
+    """
+    Describe many books in parallel, yielding json lines as soon as they are ready (in no particular order)
+
+    :type paths: iterable of str
+    :param paths: paths of the EPUB files, e.g. find_epubs(directory)
+    :type processes: int
+    :param processes: size of the process pool, defaults to the number of cores
+    :type chunksize: int
+    :param chunksize: number of books handed to a worker at a time
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        for line in pool.imap_unordered(describe, paths, chunksize):
+            yield line
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream one json line per EPUB found in the given directories")
+    parser.add_argument("directories", nargs="+", metavar="DIRECTORY")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of worker processes (default: number of cores)")
+    args = parser.parse_args(argv)
+    for line in scan(find_epubs(*args.directories), args.processes):
+        sys.stdout.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,27 @@
 # coding=utf-8
 import unittest
+import os
 import urllib2 
 import zipfile
 import random
-from tempfile import NamedTemporaryFile
+import json
+import shutil
+import struct
+import subprocess
+import sys
+from tempfile import NamedTemporaryFile, mkdtemp
 from StringIO import StringIO
-from . import EPUB
+from . import EPUB, InvalidEpub, Stats, CompressionPolicy
+from .scan import scan
+from .cache import MetadataCache, MemberCache
+from .bench import generate, run_case, memory
+from .dedup import duplicates, ContentStore, main as dedup_main
+from . import diff
+from .merge import merge, split
+try:
+    from .aio import AsyncEPUB, asyncio
+except ImportError:
+    AsyncEPUB = None
 try:
     import lxml.etree as ET
 except ImportError:
@@ -110,3 +126,636 @@ class EpubTests(unittest.TestCase):
         self.assertEqual(len(epub.opf[1]), 2)  # manifest
         self.assertEqual(len(epub.opf[2]), 1)  # spine
         self.assertEqual(len(epub.opf[3]), 0)  # guide
+
+    def test_passthrough_copy(self):
+        epub = EPUB(self.epub2file, mode='a')
+        epub.addmetadata('test', 'GOOD')
+        new_epub = StringIO()
+        epub.writetodisk(new_epub)
+        new_zip = zipfile.ZipFile(new_epub)
+        self.assertIsNone(new_zip.testzip())
+        for item in epub.infolist():
+            if item.filename in ('mimetype', 'META-INF/container.xml', epub.opf_path, epub.ncx_path):
+                continue
+            copied = new_zip.getinfo(item.filename)
+            self.assertEqual(copied.CRC, item.CRC)
+            self.assertEqual(copied.compress_type, item.compress_type)
+            self.assertEqual(copied.compress_size, item.compress_size)
+            self.assertEqual(new_zip.read(item.filename), epub.read(item.filename))
+
+    def test_append_spool(self):
+        epub = EPUB(self.epub2file, mode='a', spool_size=16)
+        members = len(epub.namelist())
+        epub.additem('<?xml version="1.0" encoding="utf-8"?>' * 100, "spooled.xhtml", "application/xhtml+xml")
+        self.assertTrue(epub._spool._rolled)  # pending writes past spool_size are on disk
+        output = NamedTemporaryFile(suffix='.epub', delete=False)
+        output.close()
+        epub.writetodisk(output.name)
+        epub.close()
+        new_epub = EPUB(output.name)
+        self.assertEqual(members + 1, len(new_epub.namelist()))
+        self.assertIsNone(new_epub.testzip())
+
+    def test_new_epub_streaming(self):
+        target = StringIO()
+        epub = EPUB(target, mode='w')
+        epub.addpart('<html>streamed</html>', "streamed.xhtml", "application/xhtml+xml")
+        self.assertIn('OEBPS/streamed.xhtml', target.getvalue())  # flushed before close()
+        self.assertEqual(epub._write_files, {})
+        epub.close()
+        new_zip = zipfile.ZipFile(target)
+        self.assertEqual(new_zip.namelist()[0], 'mimetype')
+        self.assertIsNone(new_zip.testzip())
+        epub = EPUB(target)
+        self.assertEqual(len(epub.opf[2]), 1)  # spine
+        self.assertEqual(epub.read('OEBPS/streamed.xhtml'), '<html>streamed</html>')
+
+    def test_lazy(self):
+        eager = EPUB(self.epub2file)
+        epub = EPUB(self.epub2file, lazy=True)
+        self.assertEqual(epub.title, eager.title)
+        self.assertEqual(epub.id, eager.id)
+        self.assertEqual(epub.cover, eager.cover)
+        self.assertNotIn('opf', epub.__dict__)  # metadata-only fast path
+        self.assertEqual(epub.info, eager.info)
+        self.assertIs(epub.info['metadata'], epub.metadata)
+        self.assertNotIn('ncx', epub.__dict__)
+        self.assertEqual(epub.contents, eager.contents)
+
+    def test_scan(self):
+        bad = NamedTemporaryFile(suffix='.epub', delete=False)
+        bad.write('not a zip file')
+        bad.close()
+        records = [json.loads(line) for line in scan([self.epub2file.name, bad.name, self.epub2file2.name], 2)]
+        self.assertEqual(len(records), 3)
+        errors = [r for r in records if 'error' in r]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]['path'], bad.name)
+        books = [r for r in records if 'error' not in r]
+        self.assertTrue(all(r['info']['manifest'] and r['id'] for r in books))
+
+    def test_metadata_cache(self):
+        cache = MetadataCache(max_entries=1)
+        epub = EPUB(self.epub2file.name, cache=cache)
+        self.assertEqual(len(cache), 1)
+        cached = EPUB(self.epub2file.name, cache=cache)
+        self.assertNotIn('opf', cached.__dict__)  # no XML parsed
+        self.assertEqual(cached.info, epub.info)
+        self.assertEqual(cached.contents, epub.contents)
+        self.assertEqual((cached.id, cached.cover, cached.ncx_path), (epub.id, epub.cover, epub.ncx_path))
+        EPUB(self.epub2file2, cache=cache)  # keyed by central directory CRCs, evicts the first entry
+        self.assertEqual(len(cache), 1)
+        cache.close()
+
+    def test_manifest_index(self):
+        epub = EPUB(self.epub2file, mode='a')
+        self.assertEqual([x.as_dict() for x in epub.manifest.items], epub.info['manifest'])
+        for itemref in epub.manifest.spine:
+            self.assertIn(itemref.idref, epub.manifest.by_id)
+        self.assertEqual(epub.manifest.toc.mimetype, 'application/x-dtbncx+xml')
+        epub.addpart('<html/>', "indexed.xhtml", "application/xhtml+xml", 1)
+        fileid = epub.manifest.by_href["indexed.xhtml"].id
+        self.assertEqual(epub.manifest.by_id[fileid].href, "indexed.xhtml")
+        self.assertEqual(epub.manifest.spine[1].idref, fileid)
+        self.assertEqual(epub.info['spine'][1], {'idref': fileid})
+        self.assertRaises(InvalidEpub, epub.additem, '<html/>', "indexed.xhtml", "application/xhtml+xml")
+        epub._delete(os.path.join(epub.root_folder, "indexed.xhtml"))
+        self.assertNotIn(fileid, epub.manifest.by_id)
+        self.assertNotIn(fileid, epub.manifest.by_idref)
+        self.assertNotIn({'idref': fileid}, epub.info['spine'])
+
+    def test_itertext(self):
+        epub = EPUB(self.epub2file.name)
+        chunks = list(epub.itertext())
+        self.assertTrue(chunks)
+        spine = [x['idref'] for x in epub.info['spine']]
+        idrefs = [idref for idref, href, text in chunks]
+        self.assertEqual(sorted(set(idrefs), key=spine.index), sorted(set(idrefs), key=idrefs.index))  # spine order
+        self.assertTrue(all(text.strip() for idref, href, text in chunks))
+        self.assertEqual(list(epub.itertext(threads=2)), chunks)
+
+
+class OfflineEpubTests(unittest.TestCase):
+
+    def setUp(self):
+        # synthetic epub test files, no network needed
+        self.epub2file = NamedTemporaryFile(suffix='.epub', delete=False)
+        generate(self.epub2file, chapters=8, images=2, ncx_depth=2)
+        self.epub2file.close()
+        self.epub2file2 = NamedTemporaryFile(suffix='.epub', delete=False)
+        generate(self.epub2file2, chapters=3, guide=False, seed=1)
+        self.epub2file2.close()
+
+    def tearDown(self):
+        os.remove(self.epub2file.name)
+        os.remove(self.epub2file2.name)
+
+    def test_generate(self):
+        epub = EPUB(self.epub2file.name)
+        self.assertEqual(len(epub.info['spine']), 8)
+        self.assertEqual(len(epub.info['manifest']), 11)
+        self.assertEqual(len(epub.contents), 8)
+        self.assertEqual(epub.cover, 'image0000')
+        self.assertEqual(len(epub.info['guide']), 1)
+        self.assertEqual(EPUB(self.epub2file2.name).info['guide'], None)
+        self.assertIsNone(epub.testzip())
+        # deterministic output
+        again = StringIO()
+        generate(again, chapters=8, images=2, ncx_depth=2)
+        self.assertEqual(again.getvalue(), open(self.epub2file.name, 'rb').read())
+
+    def test_addpart(self):
+        epub = EPUB(self.epub2file.name, mode='a')
+        members = len(epub.namelist())
+        epub.addpart('<html/>', "testpart.xhtml", "application/xhtml+xml", 2)
+        epub.addmetadata('test', 'GOOD')
+        new_epub = StringIO()
+        epub.writetodisk(new_epub)
+        epub = EPUB(new_epub)
+        self.assertEqual(len(epub.info['spine']), 9)
+        self.assertEqual(epub.info['spine'][2]['idref'], epub.manifest.by_href['testpart.xhtml'].id)
+        self.assertEqual(epub.info['metadata']['test'], 'GOOD')
+        self.assertEqual(members + 1, len(epub.namelist()))
+
+    def test_addpart_past_spine(self):
+        epub = EPUB(self.epub2file.name, mode='a')
+        epub.addpart('<html/>', "testpart.xhtml", "application/xhtml+xml", 9)  # past the end of the 8 chapters
+        self.assertEqual(epub.info['spine'][-1]['idref'], epub.manifest.by_href['testpart.xhtml'].id)
+        self.assertEqual([x['href'] for x in epub.info['guide']][-1], 'testpart.xhtml')
+
+    def test_run_case(self):
+        results = run_case(dict(chapters=3), repeat=1)
+        for key in ('import', 'cold_open', 'open', 'open_lazy', 'title', 'info', 'addpart', 'addmetadata',
+                    'writetodisk', 'max_rss_kb'):
+            self.assertIn(key, results)
+        self.assertLess(results['import'], results['cold_open'])
+        self.assertEqual(set(results['max_rss_kb']), set(['import', 'open', 'info', 'writetodisk']))
+        # measured per operation, in interpreters that don't count the memory of this one
+        ballast = 'x' * (64 << 20)
+        rss = memory(self.epub2file.name, self.epub2file2.name)
+        self.assertTrue(all(0 < rss[x] < len(ballast) >> 10 for x in rss))
+
+    def test_observer(self):
+        stats = Stats()
+        epub = EPUB(self.epub2file.name, mode='a', observer=stats)
+        self.assertEqual(set(stats.phases), set(['container', 'opf', 'ncx']))
+        epub.addmetadata('test', 'GOOD')
+        epub.writetodisk(StringIO())
+        for phase in ('package', 'copy', 'pending', 'writetodisk'):
+            self.assertEqual(stats.phases[phase]['calls'], 1)
+        self.assertEqual(stats.phases['copy']['members'], len(epub.namelist()) - 4)
+        self.assertEqual(stats.phases['writetodisk']['members'], len(epub.namelist()))
+        self.assertTrue(stats.phases['writetodisk']['bytes_written'] > stats.phases['copy']['bytes_written'])
+
+    def test_compression_policy(self):
+        epub = EPUB(self.epub2file.name, mode='a', compression=CompressionPolicy(level=9, threads=2))
+        for i in range(5):
+            epub.additem('<p>compressible</p>' * 500, "text%d.xhtml" % i, "application/xhtml+xml")
+        epub.additem('\x89PNG' * 500, "image.png", "image/png")
+        new_epub = StringIO()
+        epub.writetodisk(new_epub)
+        new_zip = zipfile.ZipFile(new_epub)
+        self.assertIsNone(new_zip.testzip())
+        self.assertEqual(new_zip.getinfo('mimetype').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(new_zip.getinfo(epub.opf_path).compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(new_zip.getinfo('OEBPS/image.png').compress_type, zipfile.ZIP_STORED)
+        for i in range(5):
+            info = new_zip.getinfo('OEBPS/text%d.xhtml' % i)
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertTrue(info.compress_size < info.file_size)
+        # members are written in the order they were added
+        epub = EPUB(self.epub2file.name, mode='a', compression=CompressionPolicy(level=9, threads=4))
+        added = ['OEBPS/add%02d.xhtml' % i for i in range(1, 13)]
+        for path in added:
+            epub.additem('<p>%s</p>' % path * 500, os.path.basename(path), "application/xhtml+xml")
+        new_epub = StringIO()
+        epub.writetodisk(new_epub)
+        self.assertEqual([x for x in zipfile.ZipFile(new_epub).namelist() if x.startswith('OEBPS/add')], added)
+        stored = StringIO()
+        epub = EPUB(self.epub2file.name, mode='a', compression=CompressionPolicy(level=0))
+        epub.additem('<p>compressible</p>' * 500, "text.xhtml", "application/xhtml+xml")
+        epub.writetodisk(stored)
+        self.assertEqual(zipfile.ZipFile(stored).getinfo('OEBPS/text.xhtml').compress_type, zipfile.ZIP_STORED)
+
+    def test_memberview(self):
+        epub = EPUB(self.epub2file.name)
+        image = 'OEBPS/Images/image0000.jpg'
+        chapter = 'OEBPS/Text/chapter0001.xhtml'
+        view = epub.memberview(image)
+        self.assertIsInstance(view, memoryview)
+        image_data = epub.read(image)
+        self.assertEqual(view.tobytes(), image_data)
+        stream = epub.memberview(chapter)  # deflated
+        self.assertEqual(stream.read(), epub.read(chapter))
+        for name in (image, chapter):
+            data = epub.read(name)
+            self.assertEqual(epub.readrange(name, 10, 1000).tobytes(), data[10:1000])
+            self.assertEqual(epub.readrange(name, 2000).tobytes(), data[2000:])
+        epub.close()
+        self.assertEqual(view.tobytes(), image_data)  # the mapping outlives close()
+        epub = EPUB(StringIO(open(self.epub2file.name, 'rb').read()))  # not mappable
+        self.assertEqual(epub.readrange(image, 10, 1000).tobytes(), epub.read(image)[10:1000])
+
+    def test_incremental_save(self):
+        size = os.path.getsize(self.epub2file.name)
+        epub = EPUB(self.epub2file.name, mode='a')
+        offsets = dict((x.filename, x.header_offset) for x in epub.infolist())
+        epub.addmetadata('test', 'GOOD')
+        epub.addpart('<html/>', "testpart.xhtml", "application/xhtml+xml")
+        epub.save()
+        self.assertIsNone(epub.testzip())
+        self.assertEqual(epub._write_files, {})
+        for x in epub.infolist():
+            if x.filename in offsets and x.filename not in (epub.opf_path, epub.ncx_path):
+                self.assertEqual(x.header_offset, offsets[x.filename])  # untouched members haven't moved
+        self.assertTrue(os.path.getsize(self.epub2file.name) - size < size / 10)
+        self.assertTrue(epub.deadspace() > 0)  # the old OPF and NCX
+        self.assertFalse(epub.compact(threshold=0.5))
+        self.assertTrue(epub.compact(threshold=0))
+        self.assertEqual(epub.deadspace(), 0)
+        epub.close()
+        epub = EPUB(self.epub2file.name)
+        self.assertEqual(epub.info['metadata']['test'], 'GOOD')
+        self.assertIn('OEBPS/testpart.xhtml', epub.namelist())
+        self.assertIsNone(epub.testzip())
+        # Info-ZIP writes a longer extended timestamp in the local headers than in the central directory
+        source = zipfile.ZipFile(self.epub2file.name)
+        target = zipfile.ZipFile(self.epub2file2.name, 'w', zipfile.ZIP_DEFLATED)
+        for name in source.namelist():
+            zinfo = zipfile.ZipInfo(name, (2000, 1, 1, 0, 0, 0))
+            zinfo.extra = struct.pack('<HHBll', 0x5455, 9, 3, 946684800, 946684800)
+            target.writestr(zinfo, source.read(name))
+            zinfo.extra = struct.pack('<HHBl', 0x5455, 5, 1, 946684800)    # central directory only
+        target.close()
+        self.assertEqual(EPUB(self.epub2file2.name).deadspace(), 0)
+
+    def test_batch(self):
+        epub = EPUB(self.epub2file.name, mode='a')
+        spine = [x['idref'] for x in epub.info['spine']]
+        with epub.batch() as batch:
+            first = batch.addpart('<html/>', "Text/first.xhtml", "application/xhtml+xml", 0, title="First")
+            middle = batch.addpart('<html/>', "Text/middle.xhtml", "application/xhtml+xml", 4, title="Middle")
+            last = batch.addpart('<html/>', "Text/last.xhtml", "application/xhtml+xml", title="Last")
+            batch.addmetadata('test', 'GOOD')
+            batch.delete('OEBPS/Text/chapter0001.xhtml')
+            self.assertRaises(InvalidEpub, batch.additem, '<html/>', "Text/first.xhtml", "application/xhtml+xml")
+            self.assertEqual(len(epub.info['spine']), 8)  # nothing applied before commit
+        # positions refer to the spine before the batch
+        expected = [first] + spine[:1] + spine[2:4] + [middle] + spine[4:] + [last]
+        self.assertEqual([x['idref'] for x in epub.info['spine']], expected)
+        self.assertEqual(epub.info['metadata']['test'], 'GOOD')
+        names = [x['name'] for x in epub.contents]
+        self.assertEqual(names[0], 'First')
+        self.assertEqual(names[-1], 'Last')
+        self.assertIn('Middle', names)
+        self.assertNotIn('Chapter 1', names)
+        play_order = [x.get('playOrder') for x in epub.ncx.iter('{http://www.daisy.org/z3986/2005/ncx/}navPoint')]
+        self.assertEqual(play_order, [str(i + 1) for i in range(len(play_order))])
+        new_epub = StringIO()
+        epub.writetodisk(new_epub)
+        epub = EPUB(new_epub)
+        self.assertEqual([x['idref'] for x in epub.info['spine']], expected)
+        self.assertNotIn('OEBPS/Text/chapter0001.xhtml', epub.namelist())
+        self.assertIn('OEBPS/Text/middle.xhtml', epub.namelist())
+
+    def test_batch_cancelled_part(self):
+        epub = EPUB(self.epub2file.name, mode='a')
+        with epub.batch() as batch:
+            batch.addpart('<html/>', "Text/x.xhtml", "application/xhtml+xml", 2, title="X")
+            batch.addpart('<html/>', "Text/y.xhtml", "application/xhtml+xml", title="Y")
+            batch.delete('OEBPS/Text/x.xhtml')
+        self.assertNotIn('Text/x.xhtml', [x['href'] for x in epub.info['manifest']])
+        self.assertEqual(len(epub.info['spine']), 9)
+        self.assertEqual([x['name'] for x in epub.contents][-1], 'Y')
+        new_epub = StringIO()
+        epub.writetodisk(new_epub)
+        self.assertNotIn('OEBPS/Text/x.xhtml', EPUB(new_epub).namelist())
+
+    def test_member_cache(self):
+        cache = MemberCache(max_bytes=64 * 1024)
+        epub = EPUB(self.epub2file.name, mode='a', member_cache=cache)
+        name = 'OEBPS/Text/chapter0002.xhtml'
+        before = cache.stats()
+        data = epub.read(name)
+        self.assertEqual(epub.read(name), data)
+        self.assertIs(epub.parse(name), epub.parse(name))
+        stats = cache.stats()
+        # parse() reuses the cached bytes
+        self.assertEqual((stats['hits'] - before['hits'], stats['misses'] - before['misses']), (3, 2))
+        # shared across instances of the same file
+        other = EPUB(self.epub2file.name, member_cache=cache)
+        self.assertEqual(other.read(name), data)
+        self.assertEqual(cache.stats()['misses'], stats['misses'])
+        # invalidated on delete
+        epub._delete(name)
+        self.assertNotIn(name, [x[1] for x in cache._entries])
+        # past the byte budget, the least recently used entries go
+        for zinfo in epub.infolist():
+            epub.read(zinfo)
+        self.assertLessEqual(cache.stats()['bytes'], cache.max_bytes)
+        self.assertGreater(cache.stats()['evictions'], 0)
+
+    @unittest.skipIf(AsyncEPUB is None, "requires asyncio or trollius")
+    def test_async(self):
+        loop = asyncio.new_event_loop()
+        try:
+            epub = loop.run_until_complete(AsyncEPUB.open(self.epub2file.name, loop=loop))
+            reads = [epub.read('OEBPS/Text/chapter%04d.xhtml' % i) for i in range(8)]
+            info = epub.info()
+            chapters = loop.run_until_complete(asyncio.gather(*reads, loop=loop))
+            self.assertEqual(len(loop.run_until_complete(info)['spine']), 8)
+            self.assertEqual(chapters[3], epub.epub.read('OEBPS/Text/chapter0003.xhtml'))
+            self.assertTrue(loop.run_until_complete(epub.text()))
+            loop.run_until_complete(epub.close())
+        finally:
+            loop.close()
+
+    def test_verify(self):
+        epub = EPUB(self.epub2file.name)
+        report = epub.verify(threads=3)
+        self.assertTrue(report['ok'])
+        self.assertEqual(report['members'], len(epub.namelist()))
+        self.assertEqual(epub.verify(), report)
+        epub.close()
+        # corrupt a chapter and break some references
+        source = EPUB(self.epub2file.name, mode='a')
+        source.addpart('<html/>', "Text/extra.xhtml", "application/xhtml+xml")
+        source._delete('OEBPS/Text/chapter0003.xhtml')
+        source.ncx.find('.//{http://www.daisy.org/z3986/2005/ncx/}content').set('src', 'Text/missing.xhtml')
+        source.manifest.spine_element.append(source.manifest.spine_element[0].makeelement(
+            '{http://www.idpf.org/2007/opf}itemref', {'idref': 'nowhere'}))
+        source.writetodisk(self.epub2file2.name)
+        data = open(self.epub2file2.name, 'rb').read()
+        chapter = zipfile.ZipFile(self.epub2file2.name).getinfo('OEBPS/Text/chapter0005.xhtml')
+        offset = chapter.header_offset + 30 + len(chapter.filename) + len(chapter.extra) + 10
+        data = data[:offset] + chr(ord(data[offset]) ^ 0xff) + data[offset + 1:]
+        open(self.epub2file2.name, 'wb').write(data)
+        report = EPUB(self.epub2file2.name, lazy=True).verify(threads=2)
+        self.assertFalse(report['ok'])
+        self.assertEqual([x['name'] for x in report['crc']], ['OEBPS/Text/chapter0005.xhtml'])
+        self.assertEqual(report['missing'],
+                         [{'kind': 'ncx', 'ref': 'Text/missing.xhtml', 'path': 'OEBPS/Text/missing.xhtml'}])
+        self.assertEqual(report['dangling'], [{'kind': 'spine', 'ref': 'nowhere'}])
+
+    def test_delete_navpoints(self):
+        epub = EPUB(self.epub2file.name, mode='a')
+        epub._delete('OEBPS/Text/chapter0001.xhtml', 'OEBPS/Text/chapter0004.xhtml')
+        epub.save()
+        epub = EPUB(self.epub2file.name)
+        self.assertTrue(epub.verify()['ok'])
+        self.assertEqual([x['src'] for x in epub.contents],
+                         ['OEBPS/Text/chapter%04d.xhtml' % i for i in (0, 2, 3, 5, 6, 7)])
+        play_order = [x.get('playOrder') for x in epub.ncx.iter('{http://www.daisy.org/z3986/2005/ncx/}navPoint')]
+        self.assertEqual(play_order, [str(i + 1) for i in range(6)])
+
+    def test_dedup(self):
+        directory = mkdtemp()
+        try:
+            copy = os.path.join(directory, 'copy.epub')
+            shutil.copy(self.epub2file.name, copy)
+            paths = [self.epub2file.name, self.epub2file2.name, copy]
+            report = duplicates(paths)
+            names = set(x['members'][0]['name'] for x in report)
+            self.assertEqual(names, set(EPUB(copy).namelist()))
+            container = [x for x in report if x['members'][0]['name'] == 'META-INF/container.xml'][0]
+            self.assertEqual(len(container['members']), 3)
+            # a file that isn't a zip is reported and skipped, a zip that isn't an epub is still compared
+            bad, plain = os.path.join(directory, 'bad.epub'), os.path.join(directory, 'plain.epub')
+            open(bad, 'wb').write('not a zip file')
+            plain_zip = zipfile.ZipFile(plain, 'w')
+            plain_zip.writestr('copied.xhtml', EPUB(copy).read('OEBPS/Text/chapter0000.xhtml'))
+            plain_zip.close()
+            self.assertRaises(zipfile.BadZipfile, duplicates, [bad] + paths)
+            errors = []
+            report = duplicates([bad] + paths + [plain], errors=errors)
+            self.assertEqual([(x['path'], x['error']) for x in errors], [(bad, 'BadZipfile')])
+            chapter = [x for x in report if x['members'][0]['name'] == 'OEBPS/Text/chapter0000.xhtml'][0]
+            self.assertIn({'path': plain, 'name': 'copied.xhtml'}, chapter['members'])
+
+            store = ContentStore(os.path.join(directory, 'store'))
+            first = store.export(self.epub2file.name, 'first')
+            self.assertEqual(first['added'], first['members'])
+            self.assertEqual(store.export(copy, 'copy')['added'], 0)
+            self.assertLess(store.export(self.epub2file2.name, 'second')['added'], len(EPUB(copy).namelist()))
+            self.assertEqual(store.books(), ['copy', 'first', 'second'])
+
+            rebuilt = os.path.join(directory, 'rebuilt.epub')
+            store.rebuild('second', rebuilt)
+            original, epub = EPUB(self.epub2file2.name), EPUB(rebuilt)
+            self.assertEqual(epub.namelist(), original.namelist())
+            for name in original.namelist():
+                self.assertEqual(epub.read(name), original.read(name))
+            self.assertTrue(epub.verify()['ok'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dedup_keys(self):
+        directory = mkdtemp()
+        try:
+            corpus = os.path.join(directory, 'corpus')
+            for folder, source in (('a', self.epub2file), ('b', self.epub2file2)):
+                os.makedirs(os.path.join(corpus, folder))
+                shutil.copy(source.name, os.path.join(corpus, folder, 'book.epub'))
+            store = ContentStore(os.path.join(directory, 'store'))
+            store.export(os.path.join(corpus, 'a', 'book.epub'))
+            store.export(os.path.join(corpus, 'a', 'book.epub'))    # same source: updated
+            self.assertRaises(ValueError, store.export, os.path.join(corpus, 'b', 'book.epub'))
+            self.assertEqual(store.books(), ['book'])
+
+            store = os.path.join(directory, 'store2')
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                dedup_main(['export', '--store', store, corpus])
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(ContentStore(store).books(), ['a/book', 'b/book'])
+            rebuilt = os.path.join(directory, 'rebuilt.epub')
+            dedup_main(['rebuild', '--store', store, 'a/book', rebuilt])
+            self.assertEqual(open(rebuilt, 'rb').read(), open(self.epub2file.name, 'rb').read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_diff(self):
+        old = EPUB(self.epub2file.name, mode='a')
+        old.addmetadata('subject', 'Revised')
+        old.addpart('<html/>', "Text/extra.xhtml", "application/xhtml+xml", 2)
+        old._writestr('OEBPS/Text/chapter0004.xhtml', '<html>changed</html>')
+        old._delete('OEBPS/Images/image0001.jpg')
+        new_file = StringIO()
+        old.writetodisk(new_file)
+        old, new = EPUB(self.epub2file.name), EPUB(new_file)
+
+        patch = diff.diff(old, new)
+        self.assertEqual(patch['added'], ['OEBPS/Text/extra.xhtml'])
+        self.assertEqual(patch['removed'], ['OEBPS/Images/image0001.jpg'])
+        # container.xml, OPF and NCX were serialized anew by writetodisk()
+        self.assertEqual(set(patch['changed']), set(['OEBPS/Text/chapter0004.xhtml', 'OEBPS/content.opf',
+                                                     'OEBPS/toc.ncx', 'META-INF/container.xml']))
+        self.assertNotIn('OEBPS/Images/image0000.jpg', patch['data'])   # unchanged members aren't carried
+        changes = patch['changes']
+        self.assertEqual(changes['metadata'], {'subject': [None, 'Revised']})
+        self.assertEqual(changes['manifest']['removed'], ['image0001'])
+        self.assertEqual(len(changes['manifest']['added']), 1)
+        self.assertEqual(changes['spine']['new'][2], changes['manifest']['added'][0])
+        self.assertIsNone(changes['contents'])
+
+        patch_file = StringIO()
+        diff.write_patch(patch, patch_file)
+        self.assertLess(len(patch_file.getvalue()), len(new_file.getvalue()))
+        epub = EPUB(self.epub2file.name, mode='a')
+        diff.apply(epub, diff.read_patch(patch_file))
+        rebuilt = StringIO()
+        epub.writetodisk(rebuilt)
+        rebuilt = EPUB(rebuilt)
+        self.assertEqual(sorted(rebuilt.namelist()), sorted(new.namelist()))
+        for name in new.namelist():
+            if name not in ('OEBPS/content.opf', 'OEBPS/toc.ncx'):
+                self.assertEqual(rebuilt.read(name), new.read(name))
+        self.assertEqual(rebuilt.info, new.info)
+        self.assertEqual(rebuilt.contents, new.contents)
+        # a patch doesn't apply to another book
+        self.assertRaises(InvalidEpub, diff.apply, EPUB(self.epub2file2.name, mode='a'), patch)
+
+    def test_merge_split(self):
+        omnibus = StringIO()
+        merge([self.epub2file.name, self.epub2file2.name], omnibus, title="Omnibus")
+        epub = EPUB(omnibus)
+        self.assertEqual(epub.info['metadata']['title'], 'Omnibus')
+        self.assertEqual(len(epub.info['spine']), 8 + 3)
+        self.assertEqual(epub.info['spine'][0]['idref'], 'book1-chapter0000')
+        self.assertEqual(epub.info['spine'][8]['idref'], 'book2-chapter0000')
+        self.assertEqual(epub.read('OEBPS/book2/Text/chapter0001.xhtml'),
+                         EPUB(self.epub2file2.name).read('OEBPS/Text/chapter0001.xhtml'))
+        self.assertEqual([x['src'] for x in epub.contents][7:9],
+                         ['OEBPS/book1/Text/chapter0007.xhtml', 'OEBPS/book2/Text/chapter0000.xhtml'])
+        play_order = [x.get('playOrder') for x in epub.ncx.iter('{http://www.daisy.org/z3986/2005/ncx/}navPoint')]
+        self.assertEqual(play_order, [str(i + 1) for i in range(11)])
+        self.assertEqual([x['href'] for x in epub.info['guide']], ['book1/Text/chapter0000.xhtml'])
+        self.assertEqual(epub.cover, 'book1-image0000')
+        self.assertTrue(epub.verify()['ok'])
+
+        volumes = [StringIO(), StringIO()]
+        split(omnibus, volumes, [0, 8])
+        first, second = EPUB(volumes[0]), EPUB(volumes[1])
+        self.assertEqual(first.info['metadata']['title'], 'Omnibus (1/2)')
+        self.assertEqual([x['idref'] for x in second.info['spine']],
+                         ['book2-chapter%04d' % i for i in range(3)])
+        self.assertEqual(len(first.contents), 8)
+        self.assertEqual(second.contents[0]['src'], 'OEBPS/book2/Text/chapter0000.xhtml')
+        self.assertEqual(second.ncx.find('.//{http://www.daisy.org/z3986/2005/ncx/}navPoint').get('playOrder'), '1')
+        self.assertIn('OEBPS/book1/Images/image0001.jpg', second.namelist())  # resources go in every volume
+        self.assertEqual((first.cover, second.cover), ('book1-image0000', 'book1-image0000'))
+        self.assertTrue(first.verify()['ok'] and second.verify()['ok'])
+        # volumes keep every metadata entry of the source, but its identifier and title
+        source = EPUB(self.epub2file.name, mode='a')
+        source.addmetadata('subject', 'Fiction')
+        source.writetodisk(self.epub2file2.name)
+        volumes = [StringIO(), StringIO()]
+        split(self.epub2file2.name, volumes, [0, 4])
+        volume = EPUB(volumes[1])
+        self.assertNotEqual(volume.id, source.id)
+        self.assertEqual(volume.metadata['title'], 'Benchmark 0 (2/2)')
+        self.assertEqual(dict((x, y) for x, y in volume.metadata.items() if x not in ('identifier', 'title')),
+                         dict((x, y) for x, y in source.metadata.items() if x not in ('identifier', 'title')))
+
+    def test_light_import(self):
+        # importing pyepub and lazily opening a book must not pull in the slower modules
+        script = ("import sys, pyepub\n"
+                  "pyepub.EPUB(sys.argv[1], lazy=True)\n"
+                  "sys.stdout.write(' '.join(sorted(sys.modules)))\n")
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        modules = subprocess.check_output([sys.executable, "-c", script, self.epub2file.name], cwd=package).split()
+        for module in ('uuid', 'datetime', 'mimetypes', 'tempfile', 'urllib', 'multiprocessing',
+                       'xml.etree.ElementTree', 'lxml.etree'):
+            self.assertNotIn(module, modules)
+
+    def test_writetodisk_in_place(self):
+        path = self.epub2file.name
+        os.chmod(path, 0o644)
+        names = EPUB(path).namelist()
+        # opened by name in "r" mode, and from a file object in "a" mode
+        EPUB(path).writetodisk(path)
+        with open(path, 'rb') as source:
+            epub = EPUB(source, mode='a')
+            epub.addmetadata('test', 'GOOD')
+            epub.writetodisk(path)
+        epub = EPUB(path)
+        self.assertEqual(sorted(epub.namelist()), sorted(names))
+        self.assertEqual(epub.info['metadata']['test'], 'GOOD')
+        self.assertIsNone(epub.testzip())
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        # written back to the very file object it reads from, or to another handle on the same file
+        with open(path, 'r+b') as source:
+            epub = EPUB(source, mode='a')
+            epub.addmetadata('test', 'BETTER')
+            epub.writetodisk(source)
+        with open(path, 'rb') as source:
+            epub = EPUB(source, mode='a')
+            epub.addmetadata('other', 'TOO')
+            with open(path, 'r+b') as target:
+                epub.writetodisk(target)
+        epub = EPUB(path)
+        self.assertEqual(sorted(epub.namelist()), sorted(names))
+        self.assertEqual(epub.info['metadata']['test'], ['GOOD', 'BETTER'])
+        self.assertEqual(epub.info['metadata']['other'], 'TOO')
+        self.assertIsNone(epub.testzip())
+
+    def test_metadata_cache_same_second(self):
+        cache = MetadataCache()
+        path = self.epub2file2.name
+        stat = os.stat(path)
+        self.assertEqual(EPUB(path, cache=cache).info['metadata']['title'], 'Benchmark 1')
+        # same size, same inode, same mtime: only the central directory tells the rewrite apart
+        generate(path, chapters=3, guide=False, seed=7)   # seeds 1 and 7 give books of the same size
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(os.path.getsize(path), stat.st_size)
+        self.assertEqual(EPUB(path, cache=cache).info['metadata']['title'], 'Benchmark 7')
+
+    def test_itertext_errors(self):
+        epub = EPUB(self.epub2file.name, mode='a')
+        epub._writestr('OEBPS/Text/chapter0001.xhtml',
+                       '<?xml version="1.0" encoding="utf-8"?>\n'
+                       '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">'
+                       '<html xmlns="http://www.w3.org/1999/xhtml"><body><p>caf&eacute;&nbsp;<b>au</b> lait</p>'
+                       'text <div>between</div> blocks</body></html>')
+        epub._writestr('OEBPS/Text/chapter0002.xhtml', '<html><body><p>unclosed</body></html>')
+        epub.writetodisk(self.epub2file.name)
+        epub = EPUB(self.epub2file.name)
+        self.assertRaises(InvalidEpub, list, epub.itertext())
+        for threads in (None, 2):
+            errors = []
+            chunks = [(href, text) for idref, href, text in epub.itertext(threads, errors)]
+            first = [text for href, text in chunks if href == 'Text/chapter0001.xhtml']
+            self.assertEqual(first, [u'caf\xe9 au lait', 'between', 'text blocks'])
+            self.assertEqual([x['href'] for x in errors], ['Text/chapter0002.xhtml'])
+            self.assertEqual(chunks[-1][0], 'Text/chapter0007.xhtml')     # went on to the last chapter
+
+    def test_itertext_handles(self):
+        with open(self.epub2file2.name, 'wb') as target:
+            generate(target, chapters=400, chapter_size=256)
+        epub = EPUB(self.epub2file2.name)
+        opened = []
+        init = zipfile.ZipFile.__init__
+
+        def counting(archive, *args, **kwargs):
+            opened.append(args[0])
+            init(archive, *args, **kwargs)
+        zipfile.ZipFile.__init__ = counting
+        try:
+            chunks = list(epub.itertext(threads=4))
+        finally:
+            zipfile.ZipFile.__init__ = init
+        self.assertLessEqual(len(opened), 4)   # one handle per worker thread, not one per chapter
+        self.assertEqual(chunks, list(epub.itertext()))
+        self.assertEqual(len(set(idref for idref, href, text in chunks)), 400)
+
+    def test_itertext_encoded_href(self):
+        epub = EPUB(self.epub2file.name, mode='a')
+        epub.addpart('<html><body><p>spaced out</p></body></html>', "Text/c 1.xhtml", "application/xhtml+xml")
+        epub.manifest.by_href["Text/c 1.xhtml"].element.set("href", "Text/c%201.xhtml")
+        epub.writetodisk(self.epub2file2.name)
+        epub = EPUB(self.epub2file2.name)
+        self.assertTrue(epub.verify()['ok'])
+        for threads in (None, 2):
+            chunks = list(epub.itertext(threads))
+            self.assertEqual(chunks[-1][1:], ('Text/c%201.xhtml', 'spaced out'))